@@ -1,33 +1,132 @@
+import importlib
+
 import streamlit as st
+import cache
+import perf
 from database import DatabaseManager
-from ui_processor import render_processor
-from ui_dashboard import render_dashboard
-from ui_history import render_history_manager
+
+# As telas (e o que elas importam: pandas, altair, pdfplumber) só são
+# carregadas quando abertas pela primeira vez. Nome -> (módulo, função)
+VIEWS = {
+    "📝 Processar Nota": ("ui_processor", "render_processor"),
+    "📊 Dashboard Financeiro": ("ui_dashboard", "render_dashboard"),
+    "🗂️ Histórico": ("ui_history", "render_history_manager"),
+    "📈 Preços": ("ui_prices", "render_prices"),
+}
 
 # Configuração Principal
 st.set_page_config(page_title="Divisor de Contas", layout="wide", page_icon="💰")
 
+def render_diagnostics(db_manager):
+    """Painel com o tempo de cada etapa do rerun atual (e histórico do log)."""
+    import pandas as pd
+
+    spans = perf.get_spans()
+    with st.sidebar.expander("⏱️ Diagnóstico de desempenho", expanded=True):
+        st.caption(f"Queries neste rerun: {perf.get_query_count()}")
+        if spans:
+            df_spans = pd.DataFrame(spans)
+            # Agrupa spans repetidos (ex: uma consulta de memória por item)
+            df_rerun = (
+                df_spans.groupby("span", sort=False)
+                .agg(chamadas=("ms", "size"), total_ms=("ms", "sum"), queries=("queries", "sum"))
+                .reset_index()
+                .sort_values("total_ms", ascending=False)
+            )
+            st.dataframe(df_rerun, hide_index=True, use_container_width=True)
+
+        # Estatísticas por instrução SQL desde que esta sessão conectou
+        stats = db_manager.get_statement_stats()
+        if stats:
+            st.caption("Instruções SQL desta sessão (chamadas e histograma de latência)")
+            st.dataframe(pd.DataFrame(stats), hide_index=True, use_container_width=True)
+
+        if st.button("📈 Resumo p50/p95 do log"):
+            resumo = perf.summarize(perf.load_log())
+            if resumo:
+                st.dataframe(pd.DataFrame(resumo), hide_index=True, use_container_width=True)
+            else:
+                st.info("Log vazio.")
+
+
+def get_db_manager():
+    """
+    Uma conexão por sessão, guardada no session_state.
+    Os fragmentos reexecutam sem passar pelo main(), então a conexão
+    não pode ser fechada no fim de cada rerun.
+    """
+    db_manager = st.session_state.get("db_manager")
+    if db_manager is None or not db_manager.is_alive():
+        if db_manager is not None:
+            db_manager.close()
+        db_manager = DatabaseManager(household_id=st.session_state.get("household_id"))
+        st.session_state["db_manager"] = db_manager
+    return db_manager
+
+
+def _criar_casa(db_manager):
+    nome = st.session_state["nova_casa_nome"].strip()
+    participantes = [p.strip() for p in st.session_state["nova_casa_participantes"].split(",") if p.strip()]
+    if not nome or not participantes:
+        st.toast("Informe o nome da casa e pelo menos um participante.", icon="⚠️")
+        return
+    household_id = db_manager.add_household(nome, participantes)
+    if household_id is None:
+        st.toast("Erro ao criar a casa.", icon="❌")
+        return
+    cache.invalidate()
+    st.session_state["household_id"] = household_id
+
+
+def select_household(db_manager):
+    """
+    Casa desta sessão: o padrão vem de HOUSEHOLD_ID e cada sessão pode trocar.
+    O id vai para o db_manager e entra na chave das leituras em cache.
+    """
+    casas = {c["id"]: c["nome"] for c in cache.households(db_manager)}
+    if st.session_state.get("household_id") not in casas:
+        st.session_state["household_id"] = db_manager.household_id if db_manager.household_id in casas else next(iter(casas))
+    if len(casas) > 1:
+        # A nota aberta no editor é da fila da casa anterior
+        st.sidebar.selectbox(
+            "🏠 Casa", list(casas), format_func=casas.get, key="household_id",
+            on_change=lambda: st.session_state.pop("nota_atual", None),
+        )
+    with st.sidebar.expander("➕ Nova casa"):
+        st.text_input("Nome", key="nova_casa_nome")
+        st.text_input("Participantes (separados por vírgula)", key="nova_casa_participantes")
+        st.button("Criar casa", on_click=_criar_casa, args=(db_manager,))
+    db_manager.household_id = st.session_state["household_id"]
+
+
 def main():
-    st.title("💰 Finanças: Kristian & Giulia")
-    
-    # Cria as abas principais
-    tab_proc, tab_dash, tab_hist = st.tabs(["📝 Processar Nota", "📊 Dashboard Financeiro", "🗂️ Histórico"])
-    
-    # Inicia o Banco de Dados (uma única vez)
-    db_manager = DatabaseManager()
-
-    # Cada aba chama sua função específica em outro arquivo
-    with tab_proc:
-        render_processor(db_manager)
-
-    with tab_dash:
-        render_dashboard(db_manager)
-
-    with tab_hist:
-        render_history_manager(db_manager)
-
-    # Fecha conexão
-    db_manager.close()
+    perf.start_rerun()
+    mostrar_diagnostico = st.sidebar.toggle("⏱️ Diagnóstico", value=False)
+
+    # Inicia o Banco de Dados (uma única vez por sessão)
+    db_manager = get_db_manager()
+    select_household(db_manager)
+    nomes = [p["nome"] for p in cache.participants(db_manager, db_manager.household_id)]
+    st.title(f"💰 Finanças: {' & '.join(nomes)}")
+
+    # Navegação: diferente do st.tabs (que executa todas as abas a cada rerun),
+    # só a tela escolhida roda
+    view = st.radio(
+        "Tela",
+        list(VIEWS),
+        horizontal=True,
+        key="view",
+        label_visibility="collapsed",
+    )
+
+    # Cada tela chama sua função específica em outro arquivo
+    modulo, funcao = VIEWS[view]
+    with perf.span(f"import.{modulo}"):
+        render = getattr(importlib.import_module(modulo), funcao)
+    render(db_manager)
+
+    if mostrar_diagnostico:
+        render_diagnostics(db_manager)
 
 if __name__ == "__main__":
 
@@ -0,0 +1,66 @@
+import hashlib
+import io
+
+import perf
+
+# Arquivo dos originais (PDF/XML das notas e comprovantes de Pix).
+# Fica no próprio banco, na tabela arquivos: no deploy o disco é efêmero.
+# O conteúdo vai comprimido com zstd e a chave é o sha256 do original,
+# então o mesmo arquivo enviado duas vezes ocupa espaço uma vez só.
+# Com o original guardado, dá para reler as notas depois de corrigir o parser.
+
+NIVEL_ZSTD = 10  # acima disso o ganho em PDF é pequeno e a compressão fica lenta
+
+
+def content_hash(conteudo):
+    return hashlib.sha256(conteudo).hexdigest()
+
+
+def compress(conteudo):
+    # Import adiado: só quem grava ou lê o arquivo carrega o zstandard
+    import zstandard
+
+    return zstandard.ZstdCompressor(level=NIVEL_ZSTD).compress(conteudo)
+
+
+def decompress(dados):
+    import zstandard
+
+    # O Postgres devolve BYTEA como memoryview
+    return zstandard.ZstdDecompressor().decompress(bytes(dados))
+
+
+def reparse_invoices(db_manager, notas):
+    """
+    Relê as notas arquivadas com o parser atual, uma por vez.
+    notas: linhas de get_archived_documents() do tipo "nota".
+    Gera um dict por nota comparando o que foi salvo com a nova leitura.
+    """
+    from parser import parse_invoice
+
+    for nota in notas:
+        linha = {
+            "id": nota["id"],
+            "data": nota["data"],
+            "loja": nota["descricao"],
+            "total_salvo": nota["total"],
+            "itens_salvos": nota["n_itens"],
+            "total_relido": None,
+            "itens_relidos": None,
+            "erro": None,
+        }
+        arquivo = db_manager.get_archived_file(nota["hash"])
+        if arquivo is None:
+            linha["erro"] = "Arquivo não encontrado"
+            yield linha
+            continue
+        nome, conteudo = arquivo
+        try:
+            with perf.span("archive.reparse"):
+                dados = parse_invoice(io.BytesIO(conteudo), nome)
+        except Exception as e:
+            linha["erro"] = str(e)
+        else:
+            linha["total_relido"] = round(dados["total_nota"], 2)
+            linha["itens_relidos"] = len(dados["itens"])
+        yield linha
@@ -0,0 +1,63 @@
+import argparse
+import os
+import statistics
+import time
+
+import parser
+
+# Benchmark da extração paralela de páginas.
+# Uso: python bench_parser.py nota_atacado.pdf [outra.pdf ...] --workers 1,2,4 --repeticoes 3
+# Mede o parse completo de cada PDF com cada número de processos e confere
+# que o resultado é idêntico ao sequencial. O relatório também vai para bench_output.txt.
+
+SAIDA = "bench_output.txt"
+
+
+def _medir(caminho, workers, repeticoes):
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        dados = parser.InvoiceParser(caminho, workers).parse()
+        tempos.append((time.perf_counter() - inicio) * 1000)
+    return statistics.median(tempos), dados
+
+
+def main():
+    args = argparse.ArgumentParser(description="Tempo do parser de PDF por número de processos")
+    args.add_argument("pdfs", nargs="+")
+    args.add_argument("--workers", default="1,2,4", help="lista separada por vírgula (1 = sequencial)")
+    args.add_argument("--repeticoes", type=int, default=3)
+    opcoes = args.parse_args()
+    lista_workers = [int(w) for w in opcoes.workers.split(",")]
+
+    import pdfplumber
+
+    linhas = [f"CPUs: {os.cpu_count()} | repetições: {opcoes.repeticoes} (mediana)"]
+    for caminho in opcoes.pdfs:
+        with pdfplumber.open(caminho) as pdf:
+            paginas = len(pdf.pages)
+        linhas.append(f"\n{os.path.basename(caminho)}: {paginas} páginas")
+
+        # Aquece o pool de processos fora da medição (ele é reaproveitado no uso normal)
+        for workers in lista_workers:
+            if parser.resolve_workers(workers, paginas - 1) > 1:
+                parser.InvoiceParser(caminho, workers).parse()
+
+        base_ms, base = _medir(caminho, 1, opcoes.repeticoes)
+        for workers in lista_workers:
+            ms, dados = (base_ms, base) if workers == 1 else _medir(caminho, workers, opcoes.repeticoes)
+            efetivos = parser.resolve_workers(workers, paginas - 1)
+            identico = "ok" if dados == base else "DIFERENTE"
+            linhas.append(
+                f"  workers={workers} (efetivos {efetivos}): {ms:8.0f} ms  "
+                f"speedup {base_ms / ms:4.2f}x  itens={len(dados['itens'])}  resultado {identico}"
+            )
+
+    relatorio = "\n".join(linhas)
+    print(relatorio)
+    with open(SAIDA, "w", encoding="utf-8") as f:
+        f.write(relatorio + "\n")
+
+
+if __name__ == "__main__":
+    main()
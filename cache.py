@@ -0,0 +1,141 @@
+import streamlit as st
+from streamlit.errors import StreamlitAPIException
+
+import perf
+
+# Leituras compartilhadas pelas telas e fragmentos.
+# Ficam em st.cache_data, então um fragmento que reexecuta (filtro, Pix,
+# exclusão) não volta ao banco; toda escrita chama invalidate().
+# O "_" em _db_manager faz o Streamlit não usar a conexão na chave do cache;
+# por isso toda leitura recebe também o household_id da sessão, que entra
+# na chave (sessões de casas diferentes não compartilham resultado).
+
+TTL_SEGUNDOS = 300
+
+
+def parse_dates(serie):
+    """Datas gravadas como ISO (padrão do banco) ou dd/mm/YYYY (notas antigas)."""
+    import pandas as pd
+
+    datas = pd.to_datetime(serie, format="ISO8601", errors="coerce")
+    return datas.fillna(pd.to_datetime(serie, format="%d/%m/%Y", errors="coerce"))
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def households(_db_manager):
+    # Lista de casas: a mesma para todas as sessões
+    with perf.span("cache.households"):
+        return _db_manager.get_households()
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def participants(_db_manager, household_id):
+    with perf.span("cache.participants"):
+        return _db_manager.get_participants()
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def split_rules(_db_manager, household_id):
+    with perf.span("cache.split_rules"):
+        return _db_manager.get_split_rules()
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def financial_data(_db_manager, household_id):
+    with perf.span("cache.financial_data"):
+        df_compras, df_reembolsos = _db_manager.get_financial_data()
+        # Conversão de data para uso em filtros e gráficos (IMPORTANTE)
+        df_compras["data_compra"] = parse_dates(df_compras["data_compra"])
+        return df_compras, df_reembolsos
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def invoices(_db_manager, household_id):
+    with perf.span("cache.invoices"):
+        return _db_manager.get_all_invoices()
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def reimbursements(_db_manager, household_id):
+    with perf.span("cache.reimbursements"):
+        return _db_manager.get_all_reimbursements()
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def balances(_db_manager, household_id):
+    with perf.span("cache.balances"):
+        return _db_manager.get_balances()
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def category_shares(_db_manager, household_id, data_inicio=None, data_fim=None, loja=None):
+    with perf.span("cache.category_shares"):
+        return _db_manager.get_category_shares(data_inicio, data_fim, loja)
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def products(_db_manager, household_id, termo=""):
+    with perf.span("cache.products"):
+        return _db_manager.search_products(termo)
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def price_history(_db_manager, household_id, chave):
+    with perf.span("cache.price_history"):
+        df = _db_manager.get_price_history(chave)
+        df["data_compra"] = parse_dates(df["data_compra"])
+        return df
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def store_prices(_db_manager, household_id, chave):
+    with perf.span("cache.store_prices"):
+        return _db_manager.get_store_price_comparison(chave)
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def search_items(_db_manager, household_id, texto, pagina):
+    with perf.span("cache.search_items"):
+        return _db_manager.search_items(texto, pagina)
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False)
+def archived_documents(_db_manager, household_id):
+    with perf.span("cache.archived_documents"):
+        return _db_manager.get_archived_documents()
+
+
+@st.cache_data(ttl=TTL_SEGUNDOS, show_spinner=False, max_entries=20)
+def archived_file(_db_manager, household_id, arquivo_hash):
+    # O conteúdo de um hash nunca muda; max_entries limita a memória dos originais
+    with perf.span("cache.archived_file"):
+        return _db_manager.get_archived_file(arquivo_hash)
+
+
+def invalidate():
+    """Descarta as leituras em cache depois de qualquer escrita no banco."""
+    households.clear()
+    participants.clear()
+    split_rules.clear()
+    financial_data.clear()
+    balances.clear()
+    category_shares.clear()
+    products.clear()
+    price_history.clear()
+    store_prices.clear()
+    search_items.clear()
+    invoices.clear()
+    reimbursements.clear()
+    archived_documents.clear()
+
+
+def rerun_fragment():
+    """
+    Reexecuta só o fragmento atual. Se o clique chegou num rerun completo
+    (ex: junto com outro widget), o Streamlit não aceita o escopo de
+    fragmento; aí cai para o rerun normal.
+    """
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
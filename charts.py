@@ -0,0 +1,69 @@
+import perf
+
+# Camada de dados dos gráficos.
+# O Altair embute cada linha do DataFrame como JSON na página, então todo
+# gráfico do dashboard passa por aqui antes do alt.Chart: a série temporal
+# é agrupada em dia/semana/mês conforme o período e as categorias pequenas
+# viram "Outros". O tamanho do payload fica limitado qualquer que seja o filtro.
+
+MAX_PONTOS_TEMPO = 120  # pontos na linha de evolução
+MAX_BARRAS = 15         # categorias no gráfico de barras
+MAX_FATIAS = 8          # fatias na rosca
+OUTROS = "Outros"
+
+# (período do pandas, rótulo, formato do eixo, formato do tooltip)
+GRANULARIDADES = [
+    ("D", "Dia", "%d/%m", "%d/%m/%Y"),
+    ("W", "Semana", "%d/%m", "Semana de %d/%m/%Y"),
+    ("M", "Mês", "%m/%Y", "%m/%Y"),
+    ("Q", "Trimestre", "%m/%Y", "Trimestre de %m/%Y"),
+    ("Y", "Ano", "%Y", "%Y"),
+]
+
+
+@perf.timed("charts.bin_time_series")
+def bin_time_series(df, coluna_data, coluna_valor, max_pontos=MAX_PONTOS_TEMPO, por=()):
+    """
+    Soma coluna_valor (uma coluna ou lista) por período, usando a granularidade
+    mais fina (dia -> semana -> mês -> ...) que cabe em max_pontos.
+    por: colunas que continuam separadas (ex: uma série por loja).
+    Retorna (DataFrame [coluna_data, *por, coluna_valor] ordenado, granularidade),
+    onde granularidade é a tupla de GRANULARIDADES escolhida.
+    """
+    datas = df[coluna_data]
+    for granularidade in GRANULARIDADES:
+        periodos = datas.dt.to_period(granularidade[0])
+        if periodos.nunique() <= max_pontos:
+            break
+
+    chaves = [coluna_data, *por]
+    valores = [coluna_valor] if isinstance(coluna_valor, str) else list(coluna_valor)
+    df_tempo = (
+        df[[*por, *valores]]
+        .assign(**{coluna_data: periodos.dt.start_time})
+        .groupby(chaves, as_index=False)[valores].sum()
+        .sort_values(chaves)
+    )
+    return df_tempo, granularidade
+
+
+@perf.timed("charts.cap_categories")
+def cap_categories(df, coluna_label, coluna_valor, max_itens):
+    """
+    Mantém as (max_itens - 1) maiores categorias pelo total e junta o resto
+    em "Outros". Outras colunas (ex: participante) continuam separadas.
+    Retorna um DataFrame ordenado do maior para o menor total.
+    """
+    totais = df.groupby(coluna_label)[coluna_valor].sum().sort_values(ascending=False)
+    if len(totais) <= max_itens:
+        return df.sort_values(coluna_valor, ascending=False)
+
+    mantidas = totais.index[: max_itens - 1]
+    chaves = [c for c in df.columns if c != coluna_valor]
+    df_cap = (
+        df.assign(**{coluna_label: df[coluna_label].where(df[coluna_label].isin(mantidas), OUTROS)})
+        .groupby(chaves, as_index=False, sort=False)[coluna_valor].sum()
+    )
+    # "Outros" sempre por último, mesmo que some mais que alguma categoria
+    ordem = {nome: i for i, nome in enumerate(list(mantidas) + [OUTROS])}
+    return df_cap.sort_values(coluna_label, key=lambda s: s.map(ordem), kind="stable")
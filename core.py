@@ -96,7 +96,7 @@ class ExpenseManager:
         """
         Sugere uma categoria apenas com base em palavras-chave do nome do item.
         Esta função é o 'palpite padrão'; no fluxo principal do app,
-        você pode primeiro consultar a memória (database.get_learned_category)
+        você pode primeiro consultar a memória (database.get_learned_categories)
         e usar este método só como fallback.
         """
         if not item_name:
@@ -1,77 +1,237 @@
-import psycopg2
-import psycopg2.extras
-import pandas as pd
-import streamlit as st
+import time
+import weakref
+from contextlib import contextmanager
 from datetime import datetime
+from functools import wraps
+
+import streamlit as st
+
+import archive
+import perf
+import search
+from core import ExpenseManager
+from products import normalize_unit, product_key, text_key
+from splits import SplitRule, resplit_sql
+from storage import backend_from_config, config_value
+
+# O backend (Postgres na nuvem ou SQLite local) é escolhido pela config,
+# ver storage.py. Todo SQL aqui usa placeholders %s e o backend adapta.
+#
+# Uma instalação atende várias casas (households), cada uma com seus
+# participantes. A parte de cada um em cada item fica em item_shares
+# (uma linha por participante), então entrar gente nova não muda o esquema.
+
+def _rotulo(query):
+    # Nome da instrução nas estatísticas quando ela não é preparada
+    return " ".join(query.split())[:80]
+
+
+def _leitura(func):
+    """
+    Métodos só de leitura. A conexão vive a sessão inteira e o psycopg2 abre
+    transação até para SELECT: sem encerrar, a sessão ficaria "idle in
+    transaction" segurando locks e snapshot. Chamado dentro de uma escrita
+    (transação já aberta), deixa a transação para quem a abriu.
+    Se o servidor derrubou a conexão (timeout de ociosidade, pooler), reconecta
+    e repete a leitura uma vez: os fragmentos reaproveitam o mesmo manager e
+    não passam pelo get_db_manager.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.backend.in_transaction(self.conn):
+            return func(self, *args, **kwargs)
+        try:
+            try:
+                return func(self, *args, **kwargs)
+            except self.backend.connection_errors:
+                if not self.backend.is_closed(self.conn):
+                    raise
+                self._reconnect()
+                return func(self, *args, **kwargs)
+        finally:
+            self._rollback()
+    return wrapper
 
-# Não usamos mais arquivo local, usamos a URL da nuvem
-# A URL deve estar configurada no secrets.toml (local) ou nos Secrets do Streamlit Cloud
 
 class DatabaseManager:
-    def __init__(self):
+    @perf.timed("db.connect")
+    def __init__(self, backend=None, household_id=None):
         try:
             # Busca a conexão nos segredos do Streamlit
             # Formato esperado no secrets:
-            # [connections.postgresql]
-            # dialect = "postgresql"
-            # host = "..."
-            # port = "..."
-            # database = "..."
-            # username = "..."
-            # password = "..."
-            # OU simplesmente uma string de conexão direta chamada DATABASE_URL
-            
-            # Opção A: Usando st.connection (Mais moderno no Streamlit)
-            # self.conn = st.connection("postgresql", type="sql").session 
-            # Mas para manter compatibilidade com seu código atual, vamos usar psycopg2 direto:
-            
-            db_url = st.secrets["DATABASE_URL"]
-            self.conn = psycopg2.connect(db_url)
-            self.conn.autocommit = False # Controle manual de transação igual fazíamos antes
+            # DB_BACKEND = "postgres" (padrão) + DATABASE_URL = "postgresql://..."
+            # OU
+            # DB_BACKEND = "sqlite" + SQLITE_PATH = "divcount.db" (instalação local/offline)
+            # HOUSEHOLD_ID = 1 (opcional: casa aberta por padrão; cada sessão pode trocar)
+            # STATEMENT_TIMEOUT_MS = 15000 (opcional: prazo de cada instrução)
+            self.stats = perf.StatementStats()
+            self.backend = backend or backend_from_config()
+            self.household_id = int(household_id or config_value("HOUSEHOLD_ID", 1))
+            self._connect()
             self._create_tables()
-            
+
         except Exception as e:
             st.error(f"Erro ao conectar no Banco de Dados: {e}")
             st.stop()
 
-    def _get_cursor(self):
-        # RealDictCursor faz o Postgres devolver dicionários igual o pandas gosta
-        return self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    def _connect(self):
+        self.conn = self.backend.connect()
+        # Sessão encerrada: o DatabaseManager sai do session_state e a conexão fecha junto
+        self._finalizer = weakref.finalize(self, self.conn.close)
+
+    def _reconnect(self):
+        self._finalizer()  # fecha a conexão antiga (já derrubada)
+        self._connect()
+
+    def _rollback(self):
+        # Sem conexão não há transação para desfazer (e o rollback levantaria InterfaceError)
+        if self.backend.is_closed(self.conn):
+            return
+        try:
+            self.conn.rollback()
+        except self.backend.connection_errors:
+            # Caiu agora: o servidor já descartou a transação
+            pass
+
+    def _get_cursor(self, dict_rows=False):
+        # dict_rows=True devolve dicionários igual o pandas gosta
+        # Conexão derrubada numa chamada anterior: as escritas começam por aqui
+        if self.backend.is_closed(self.conn):
+            self._reconnect()
+        return self.backend.cursor(self.conn, dict_rows=dict_rows)
+
+    @contextmanager
+    def _medir(self, nome):
+        # Cada instrução roda com prazo (STATEMENT_TIMEOUT_MS) e entra nas estatísticas
+        # Se a instrução falhar (inclusive por timeout), desfaz a transação: no Postgres
+        # ela fica abortada e todo comando seguinte da sessão falharia
+        inicio = time.perf_counter()
+        try:
+            with self.backend.deadline(self.conn):
+                yield
+        except Exception:
+            self._rollback()
+            raise
+        finally:
+            self.stats.record(nome, (time.perf_counter() - inicio) * 1000)
+
+    def _execute(self, cur, query, params=None, nome=None):
+        with self._medir(nome or _rotulo(query)):
+            if params is None:
+                return cur.execute(self.backend.sql(query))
+            return cur.execute(self.backend.sql(query), params)
+
+    def _prepared(self, cur, nome, query, params=None):
+        # Consultas quentes: PREPARE uma vez por conexão, depois só EXECUTE
+        return self._execute(cur, self.backend.prepare(cur, nome, query), params, nome)
+
+    def _insert_many(self, cur, query, rows):
+        with self._medir(_rotulo(query)):
+            self.backend.insert_many(cur, query, rows)
+
+    def _read_sql(self, query, params=None, nome=None):
+        # pandas só é carregado por quem lê DataFrames (dashboard)
+        import pandas as pd
+
+        if nome:
+            cur = self._get_cursor()
+            query = self.backend.prepare(cur, nome, query)
+            cur.close()
+        # O pandas abre o próprio cursor, então contamos a query aqui
+        perf.count_query()
+        with self._medir(nome or _rotulo(query)):
+            try:
+                return pd.read_sql_query(self.backend.sql(query), self.conn, params=params)
+            except pd.errors.DatabaseError as e:
+                # O pandas embrulha o erro do driver: queda de conexão volta a ser
+                # erro de conexão, para o @_leitura reconectar
+                if isinstance(e.__cause__, self.backend.connection_errors):
+                    raise e.__cause__ from e
+                raise
+
+    def is_alive(self):
+        """False se a conexão caiu ou está presa numa transação abortada."""
+        return self.backend.is_alive(self.conn)
+
+    def get_statement_stats(self):
+        """Chamadas e histograma de latência de cada instrução nesta conexão."""
+        return self.stats.snapshot()
+
+    def _columns(self, cur, table):
+        cur.execute(f"SELECT * FROM {table} WHERE 1 = 0")
+        return {c[0] for c in cur.description}
 
     def _create_tables(self):
-        cur = self.conn.cursor()
-        
+        cur = self._get_cursor()
+        pk = self.backend.pk_column
+        blob = self.backend.blob_column
+
+        # Casas e seus participantes
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS households (
+                id {pk},
+                nome TEXT NOT NULL
+            );
+        """)
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS participants (
+                id {pk},
+                household_id INTEGER NOT NULL,
+                nome TEXT NOT NULL,
+                cpf TEXT,
+                UNIQUE (household_id, nome),
+                FOREIGN KEY (household_id) REFERENCES households(id) ON DELETE CASCADE
+            );
+        """)
+
         # Tabela Notas (SERIAL é o autoincrement do Postgres)
-        cur.execute("""
+        cur.execute(f"""
             CREATE TABLE IF NOT EXISTS notas (
-                id SERIAL PRIMARY KEY,
+                id {pk},
+                household_id INTEGER NOT NULL DEFAULT 1,
                 data_compra TEXT NOT NULL,
                 loja TEXT NOT NULL,
                 total_nota REAL NOT NULL,
                 pagador TEXT NOT NULL,
-                forma_pagamento TEXT, 
+                forma_pagamento TEXT,
                 data_registro TEXT NOT NULL
             );
         """)
-        
+
         # Tabela Itens
-        cur.execute("""
+        cur.execute(f"""
             CREATE TABLE IF NOT EXISTS itens (
-                id SERIAL PRIMARY KEY,
+                id {pk},
                 nota_id INTEGER NOT NULL,
                 item_nome TEXT NOT NULL,
                 valor REAL NOT NULL,
                 categoria TEXT NOT NULL,
-                kristian_parte REAL NOT NULL,
-                giulia_parte REAL NOT NULL,
+                qtd REAL,
+                un TEXT,
+                vl_unit REAL,
+                product_key TEXT,
+                data_compra TEXT,
                 FOREIGN KEY (nota_id) REFERENCES notas(id) ON DELETE CASCADE
             );
         """)
-        
-        # Tabela Reembolsos
+
+        # Parte de cada participante em cada item
         cur.execute("""
+            CREATE TABLE IF NOT EXISTS item_shares (
+                item_id INTEGER NOT NULL,
+                participant_id INTEGER NOT NULL,
+                amount REAL NOT NULL,
+                PRIMARY KEY (item_id, participant_id),
+                FOREIGN KEY (item_id) REFERENCES itens(id) ON DELETE CASCADE,
+                FOREIGN KEY (participant_id) REFERENCES participants(id) ON DELETE CASCADE
+            );
+        """)
+
+        # Tabela Reembolsos
+        cur.execute(f"""
             CREATE TABLE IF NOT EXISTS reembolsos (
-                id SERIAL PRIMARY KEY,
+                id {pk},
+                household_id INTEGER NOT NULL DEFAULT 1,
                 data_pagamento TEXT NOT NULL,
                 pagador TEXT NOT NULL,
                 recebedor TEXT NOT NULL,
@@ -80,8 +240,8 @@ class DatabaseManager:
                 data_registro TEXT NOT NULL
             );
         """)
-        
-        # Tabela Memória (Aprendizado)
+
+        # Tabela Memória (Aprendizado) - compartilhada entre as casas
         cur.execute("""
             CREATE TABLE IF NOT EXISTS memoria_itens (
                 item_nome TEXT PRIMARY KEY,
@@ -89,149 +249,820 @@ class DatabaseManager:
                 ultima_atualizacao TEXT
             );
         """)
-        
+
+        # Originais das notas e comprovantes (zstd), pelo sha256 - ver archive.py
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS arquivos (
+                hash TEXT PRIMARY KEY,
+                nome TEXT NOT NULL,
+                tamanho INTEGER NOT NULL,
+                conteudo {blob} NOT NULL,
+                criado_em TEXT NOT NULL
+            );
+        """)
+
+        # Tabela Regras de Divisão (pesos em JSON: {"Kristian": 1, "Giulia": 1})
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS regras_divisao (
+                id {pk},
+                household_id INTEGER NOT NULL DEFAULT 1,
+                campo TEXT NOT NULL,
+                padrao TEXT NOT NULL,
+                pesos TEXT NOT NULL,
+                prioridade INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+
+        self._seed_household(cur)
+        self._migrate_per_person_columns(cur)
+        self._migrate_price_columns(cur)
+        self._create_search_index(cur)
+        if "arquivo_hash" not in self._columns(cur, "notas"):
+            cur.execute("ALTER TABLE notas ADD COLUMN arquivo_hash TEXT")
+        self._migrate_rule_keys(cur)
+
+        # Índices compostos: toda leitura filtra pela casa primeiro
+        indices = {
+            "idx_notas_household_data": "notas (household_id, data_compra)",
+            "idx_notas_household_pagador": "notas (household_id, pagador)",
+            "idx_itens_nota": "itens (nota_id)",
+            "idx_item_shares_participant": "item_shares (participant_id, item_id)",
+            "idx_reembolsos_household_data": "reembolsos (household_id, data_pagamento)",
+            "idx_regras_household": "regras_divisao (household_id, prioridade)",
+            "idx_itens_product_data": "itens (product_key, data_compra)",
+            "idx_notas_arquivo": "notas (arquivo_hash)",
+        }
+        for nome, alvo in indices.items():
+            self._create_missing(cur, nome, f"CREATE INDEX {nome} ON {alvo};")
+
+        # Histórico de preços: só itens com quantidade e valor (sem descontos)
+        self._create_missing(cur, "v_precos", """
+            CREATE VIEW v_precos AS
+            SELECT n.household_id, i.product_key, i.item_nome, i.data_compra, n.loja,
+                   i.un, i.qtd, i.vl_unit, i.valor
+            FROM itens i JOIN notas n ON n.id = i.nota_id
+            WHERE i.product_key IS NOT NULL AND i.qtd > 0 AND i.valor > 0;
+        """)
+
         self.conn.commit()
         cur.close()
 
+    def _create_missing(self, cur, nome, ddl):
+        # _create_tables roda a cada sessão nova. No Postgres, CREATE INDEX IF NOT
+        # EXISTS e CREATE OR REPLACE VIEW travam a tabela/view mesmo quando o objeto
+        # já existe: consulta o catálogo antes e só executa o DDL do que falta
+        if self.backend.name == "postgres":
+            cur.execute("SELECT to_regclass(%s) IS NULL", (nome,))
+            falta = cur.fetchone()[0]
+        else:
+            cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (nome,))
+            falta = cur.fetchone() is None
+        if falta:
+            cur.execute(ddl)
+
+    def _seed_household(self, cur):
+        # Primeira execução: casa padrão com os usuários do core.py
+        cur.execute("SELECT COUNT(*) FROM households")
+        if cur.fetchone()[0] > 0:
+            return
+        self._execute(cur, "INSERT INTO households (nome) VALUES (%s) RETURNING id;", ("Casa",))
+        household_id = cur.fetchone()[0]
+        for user in ExpenseManager().config.users.values():
+            self._execute(
+                cur,
+                "INSERT INTO participants (household_id, nome, cpf) VALUES (%s, %s, %s)",
+                (household_id, user.nome, user.cpf),
+            )
+
+    def _migrate_per_person_columns(self, cur):
+        # Bancos antigos: tabelas sem household_id e itens com kristian_parte/giulia_parte.
+        # As partes são copiadas para item_shares e as colunas removidas.
+        for table in ("notas", "reembolsos", "regras_divisao"):
+            if "household_id" not in self._columns(cur, table):
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN household_id INTEGER NOT NULL DEFAULT 1")
+
+        colunas_antigas = {"kristian_parte": "Kristian", "giulia_parte": "Giulia"}
+        existentes = self._columns(cur, "itens")
+        for coluna, nome in colunas_antigas.items():
+            if coluna not in existentes:
+                continue
+            # O WHERE é obrigatório no SQLite para o ON CONFLICT depois de um SELECT
+            self._execute(
+                cur,
+                f"""
+                INSERT INTO item_shares (item_id, participant_id, amount)
+                SELECT itens.id, p.id, itens.{coluna}
+                FROM itens
+                JOIN notas ON notas.id = itens.nota_id
+                JOIN participants p ON p.household_id = notas.household_id AND p.nome = %s
+                WHERE 1 = 1
+                ON CONFLICT (item_id, participant_id) DO NOTHING
+                """,
+                (nome,),
+            )
+            cur.execute(f"ALTER TABLE itens DROP COLUMN {coluna}")
+
+    def _migrate_price_columns(self, cur):
+        # Bancos antigos: itens sem qtd/un/vl_unit (ficam NULL, não dá para
+        # recuperar sem o PDF), sem chave de produto e sem a data da compra
+        existentes = self._columns(cur, "itens")
+        novas = {"qtd": "REAL", "un": "TEXT", "vl_unit": "REAL", "product_key": "TEXT", "data_compra": "TEXT"}
+        faltando = [coluna for coluna in novas if coluna not in existentes]
+        if not faltando:
+            return
+        for coluna in faltando:
+            cur.execute(f"ALTER TABLE itens ADD COLUMN {coluna} {novas[coluna]}")
+
+        cur.execute("""
+            UPDATE itens SET data_compra = (SELECT notas.data_compra FROM notas WHERE notas.id = itens.nota_id)
+            WHERE data_compra IS NULL
+        """)
+        cur.execute("SELECT DISTINCT item_nome FROM itens WHERE product_key IS NULL")
+        nomes = [row[0] for row in cur.fetchall()]
+        cur.executemany(
+            self.backend.sql("UPDATE itens SET product_key = %s WHERE item_nome = %s AND product_key IS NULL"),
+            [(product_key(nome), nome) for nome in nomes],
+        )
+
+    def _migrate_rule_keys(self, cur):
+        # Nomes de loja e item normalizados (products.text_key), usados pelas regras de divisão
+        for tabela, coluna, chave in (("notas", "loja", "loja_key"), ("itens", "item_nome", "item_key")):
+            if chave in self._columns(cur, tabela):
+                continue
+            cur.execute(f"ALTER TABLE {tabela} ADD COLUMN {chave} TEXT")
+            cur.execute(f"SELECT DISTINCT {coluna} FROM {tabela}")
+            nomes = [row[0] for row in cur.fetchall()]
+            cur.executemany(
+                self.backend.sql(f"UPDATE {tabela} SET {chave} = %s WHERE {coluna} = %s"),
+                [(text_key(nome), nome) for nome in nomes],
+            )
+
+    def _create_search_index(self, cur):
+        # Índices da busca textual (ver search.py)
+        if self.backend.name == "postgres":
+            # CREATE OR REPLACE FUNCTION trava a função a cada sessão: só cria se falta
+            cur.execute("SELECT to_regprocedure('f_unaccent(text)') IS NULL")
+            if cur.fetchone()[0]:
+                cur.execute("SAVEPOINT busca_unaccent")
+                try:
+                    cur.execute("CREATE EXTENSION IF NOT EXISTS unaccent")
+                    cur.execute(search.POSTGRES_UNACCENT)
+                    cur.execute("RELEASE SAVEPOINT busca_unaccent")
+                except Exception:
+                    # Sem permissão para instalar a extensão: busca sem remover acentos
+                    cur.execute("ROLLBACK TO SAVEPOINT busca_unaccent")
+                    cur.execute(search.POSTGRES_SEM_UNACCENT)
+            for nome, ddl in search.POSTGRES_INDICES:
+                self._create_missing(cur, nome, ddl)
+        else:
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'itens_busca'")
+            if not cur.fetchone():
+                cur.execute(search.SQLITE_TABELA)
+                cur.execute(search.SQLITE_CARGA)
+            for ddl in search.SQLITE_TRIGGERS:
+                cur.execute(ddl)
+
+    # --- CASAS ---
+    @perf.timed("db.get_households")
+    @_leitura
+    def get_households(self):
+        cur = self._get_cursor(dict_rows=True)
+        cur.execute("SELECT id, nome FROM households ORDER BY id")
+        res = cur.fetchall()
+        cur.close()
+        return [dict(row) for row in res]
+
+    @perf.timed("db.add_household")
+    def add_household(self, nome, participantes):
+        """Cria a casa com os participantes (nomes). Retorna o id da casa, ou None."""
+        cur = self._get_cursor()
+        try:
+            self._execute(cur, "INSERT INTO households (nome) VALUES (%s) RETURNING id;", (nome,))
+            household_id = cur.fetchone()[0]
+            for participante in participantes:
+                self._execute(
+                    cur,
+                    "INSERT INTO participants (household_id, nome) VALUES (%s, %s)",
+                    (household_id, participante),
+                )
+            self.conn.commit()
+            cur.close()
+            return household_id
+        except Exception as e:
+            self._rollback()
+            cur.close()
+            print(f"Erro SQL: {e}")
+            return None
+
+    # --- PARTICIPANTES ---
+    @perf.timed("db.get_participants")
+    @_leitura
+    def get_participants(self):
+        cur = self._get_cursor(dict_rows=True)
+        self._prepared(
+            cur,
+            "listar_participantes",
+            "SELECT id, nome, cpf FROM participants WHERE household_id = %s ORDER BY id",
+            (self.household_id,),
+        )
+        res = cur.fetchall()
+        cur.close()
+        return [dict(row) for row in res]
+
     # --- FUNÇÕES DE APRENDIZADO ---
-    def get_learned_category(self, item_nome):
-        cur = self.conn.cursor()
-        cur.execute("SELECT categoria FROM memoria_itens WHERE item_nome = %s", (item_nome,))
-        result = cur.fetchone()
+    @perf.timed("db.get_learned_categories")
+    @_leitura
+    def get_learned_categories(self, nomes, lote=500):
+        """Categorias aprendidas de vários itens de uma vez: {item_nome: categoria}."""
+        nomes = list(dict.fromkeys(nomes))
+        aprendidas = {}
+        cur = self._get_cursor()
+        if self.backend.name == "postgres":
+            # Um único parâmetro array: o texto da query não muda com o tamanho
+            # da nota, então prepara uma vez e o servidor reaproveita o plano
+            if nomes:
+                self._prepared(
+                    cur,
+                    "categorias_aprendidas",
+                    "SELECT item_nome, categoria FROM memoria_itens WHERE item_nome = ANY(%s)",
+                    (nomes,),
+                )
+                aprendidas.update(cur.fetchall())
+            cur.close()
+            return aprendidas
+        # O SQLite não tem array: IN em lotes (limite de variáveis por instrução)
+        for inicio in range(0, len(nomes), lote):
+            parte = nomes[inicio:inicio + lote]
+            self._execute(
+                cur,
+                f"SELECT item_nome, categoria FROM memoria_itens WHERE item_nome IN ({', '.join(['%s'] * len(parte))})",
+                parte,
+                nome="categorias_aprendidas",
+            )
+            aprendidas.update(cur.fetchall())
         cur.close()
-        return result[0] if result else None
+        return aprendidas
 
-    def learn_item(self, item_nome, categoria):
+    def _learn_items(self, cur, pares):
+        # Upsert em lote, sem commit: quem chama controla a transação.
+        # Item repetido na mesma nota: vale a última categoria (o Postgres
+        # não aceita a mesma chave duas vezes no mesmo ON CONFLICT)
         data_hoje = datetime.now().date()
-        cur = self.conn.cursor()
-        cur.execute(
+        unicos = {nome: categoria for nome, categoria in pares}
+        self._insert_many(
+            cur,
             """
             INSERT INTO memoria_itens (item_nome, categoria, ultima_atualizacao)
-            VALUES (%s, %s, %s)
+            VALUES %s
             ON CONFLICT (item_nome)
             DO UPDATE SET categoria = EXCLUDED.categoria,
                           ultima_atualizacao = EXCLUDED.ultima_atualizacao;
             """,
-            (item_nome, categoria, data_hoje),
+            [(nome, categoria, data_hoje) for nome, categoria in unicos.items()],
         )
+
+    @perf.timed("db.learn_item")
+    def learn_item(self, item_nome, categoria):
+        cur = self._get_cursor()
+        self._learn_items(cur, [(item_nome, categoria)])
         self.conn.commit()
         cur.close()
 
 
     # --- SALVAR NOTA ---
-    def save_invoice(self, data_nota, loja, total_nota, pagador, forma_pagamento, itens_processados):
+    def _insert_invoice(self, cur, participantes, data_nota, loja, total_nota, pagador, forma_pagamento,
+                        itens_processados, arquivo=None):
+        # Nota, itens, partes, memória e original, sem commit: quem chama controla a transação.
         # data_nota vem como string "dd/mm/YYYY" da UI: converte para date
         data_compra_date = datetime.strptime(data_nota, "%d/%m/%Y").date()
         data_registro = datetime.now()  # datetime completo
-        cur = self.conn.cursor()
+        arquivo_hash = self._archive_file(cur, *arquivo) if arquivo else None
+        self._prepared(
+            cur,
+            "inserir_nota",
+            """
+            INSERT INTO notas (household_id, data_compra, loja, loja_key, total_nota, pagador, forma_pagamento, data_registro, arquivo_hash)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
+            """,
+            (self.household_id, data_compra_date, loja, text_key(loja), total_nota, pagador, forma_pagamento,
+             data_registro, arquivo_hash),
+        )
+
+        nota_id = cur.fetchone()[0] # Pega o ID gerado
+
+        # Insert em lote (um round-trip só)
+        self._insert_many(
+            cur,
+            """
+            INSERT INTO itens (nota_id, item_nome, item_key, valor, categoria, qtd, un, vl_unit, product_key, data_compra)
+            VALUES %s
+            """,
+            [
+                (
+                    nota_id, item['Item'], text_key(item['Item']), item['Valor (R$)'], item['Categoria'],
+                    item.get('Qtd'), normalize_unit(item.get('Un')), item.get('Vl Unit'),
+                    product_key(item['Item']), data_compra_date,
+                )
+                for item in itens_processados
+            ],
+        )
+
+        # Os ids saem na ordem de inserção
+        self._execute(cur, "SELECT id FROM itens WHERE nota_id = %s ORDER BY id", (nota_id,))
+        item_ids = [row[0] for row in cur.fetchall()]
+
+        self._insert_many(
+            cur,
+            "INSERT INTO item_shares (item_id, participant_id, amount) VALUES %s",
+            [
+                (item_id, participantes[nome], valor)
+                for item_id, item in zip(item_ids, itens_processados)
+                for nome, valor in item["Partes"].items()
+            ],
+        )
+
+        # Ensina o robô (em lote, na mesma transação)
+        self._learn_items(cur, [(item['Item'], item['Categoria']) for item in itens_processados])
+
+    @perf.timed("db.save_invoice")
+    def save_invoice(self, data_nota, loja, total_nota, pagador, forma_pagamento, itens_processados, arquivo=None):
+        """
+        itens_processados: dicts com "Item", "Valor (R$)", "Categoria",
+        "Partes" ({nome do participante: valor}) e, opcionais, "Qtd", "Un" e "Vl Unit".
+        arquivo: (nome, bytes) do PDF/XML original, guardado no arquivo.
+        Nota, itens, partes, memória e original entram na mesma transação.
+        """
+        return self.save_invoices([{
+            "data": data_nota,
+            "loja": loja,
+            "total": total_nota,
+            "pagador": pagador,
+            "forma_pagamento": forma_pagamento,
+            "itens": itens_processados,
+            "arquivo": arquivo,
+        }])
+
+    @perf.timed("db.save_invoices")
+    def save_invoices(self, notas):
+        """
+        Várias notas numa transação só (revisão em lote): ou entram todas ou nenhuma.
+        notas: dicts com "data", "loja", "total", "pagador", "forma_pagamento",
+        "itens" (no formato do save_invoice) e, opcional, "arquivo".
+        """
+        participantes = {p["nome"]: p["id"] for p in self.get_participants()}
+        cur = self._get_cursor()
         try:
-            cur.execute(
-                """
-                INSERT INTO notas (data_compra, loja, total_nota, pagador, forma_pagamento, data_registro)
-                VALUES (%s, %s, %s, %s, %s, %s) RETURNING id;
-                """,
-                (data_compra_date, loja, total_nota, pagador, forma_pagamento, data_registro),
-            )
-            
-            nota_id = cur.fetchone()[0] # Pega o ID gerado
-
-            item_list = []
-            for item in itens_processados:
-                # Salva na lista para insert em lote
-                item_list.append((nota_id, item['Item'], item['Valor (R$)'], item['Categoria'], item['R$ Kristian'], item['R$ Giulia']))
-                
-                # Ensina o robô (um por um pois é rápido)
-                self.learn_item(item['Item'], item['Categoria'])
-
-            # Insert em lote no Postgres
-            args_str = ','.join(cur.mogrify("(%s,%s,%s,%s,%s,%s)", x).decode('utf-8') for x in item_list)
-            cur.execute("INSERT INTO itens (nota_id, item_nome, valor, categoria, kristian_parte, giulia_parte) VALUES " + args_str)
-            
+            for nota in notas:
+                self._insert_invoice(
+                    cur, participantes, nota["data"], nota["loja"], nota["total"],
+                    nota["pagador"], nota["forma_pagamento"], nota["itens"], nota.get("arquivo"),
+                )
             self.conn.commit()
             cur.close()
             return True
         except Exception as e:
-            self.conn.rollback()
+            self._rollback()
             cur.close()
             print(f"Erro SQL: {e}")
             return False
 
     # --- SALVAR REEMBOLSO ---
-    def save_reimbursement(self, pagador, recebedor, valor):
+    @perf.timed("db.save_reimbursement")
+    def save_reimbursement(self, pagador, recebedor, valor, comprovante=None):
+        # comprovante: (nome, bytes) opcional; a coluna guarda o hash do arquivo
         data_hoje = datetime.now().date()
         data_registro = datetime.now()
-        cur = self.conn.cursor()
+        cur = self._get_cursor()
         try:
-            cur.execute(
+            comprovante_hash = self._archive_file(cur, *comprovante) if comprovante else None
+            self._execute(
+                cur,
                 """
-                INSERT INTO reembolsos (data_pagamento, pagador, recebedor, valor, data_registro)
-                VALUES (%s, %s, %s, %s, %s);
+                INSERT INTO reembolsos (household_id, data_pagamento, pagador, recebedor, valor, comprovante, data_registro)
+                VALUES (%s, %s, %s, %s, %s, %s, %s);
                 """,
-                (data_hoje, pagador, recebedor, valor, data_registro),
+                (self.household_id, data_hoje, pagador, recebedor, valor, comprovante_hash, data_registro),
             )
             self.conn.commit()
             cur.close()
             return True
         except Exception as e:
-            self.conn.rollback()
+            self._rollback()
             cur.close()
             return False
 
+    # --- ARQUIVO DOS ORIGINAIS ---
+    def _archive_file(self, cur, nome, conteudo):
+        # Sem commit. Mesmo conteúdo = mesmo hash: a segunda cópia não é gravada
+        arquivo_hash = archive.content_hash(conteudo)
+        self._execute(cur, "SELECT 1 FROM arquivos WHERE hash = %s", (arquivo_hash,), nome="arquivo_existe")
+        if cur.fetchone() is None:
+            with perf.span("archive.compress"):
+                compactado = archive.compress(conteudo)
+            self._execute(
+                cur,
+                """
+                INSERT INTO arquivos (hash, nome, tamanho, conteudo, criado_em) VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (hash) DO NOTHING
+                """,
+                (arquivo_hash, nome, len(conteudo), compactado, datetime.now()),
+            )
+        return arquivo_hash
+
+    @perf.timed("db.get_archived_file")
+    @_leitura
+    def get_archived_file(self, arquivo_hash):
+        """(nome, bytes) do original, ou None."""
+        cur = self._get_cursor()
+        self._execute(cur, "SELECT nome, conteudo FROM arquivos WHERE hash = %s", (arquivo_hash,))
+        row = cur.fetchone()
+        cur.close()
+        if row is None:
+            return None
+        return row[0], archive.decompress(row[1])
+
+    @perf.timed("db.get_invoices_by_file")
+    @_leitura
+    def get_invoices_by_file(self, hashes):
+        """Notas já salvas a partir destes arquivos: {hash: data da compra}."""
+        hashes = list(hashes)
+        if not hashes:
+            return {}
+        cur = self._get_cursor()
+        self._execute(
+            cur,
+            f"""
+            SELECT arquivo_hash, MIN(data_compra) FROM notas
+            WHERE household_id = %s AND arquivo_hash IN ({', '.join(['%s'] * len(hashes))})
+            GROUP BY arquivo_hash
+            """,
+            [self.household_id, *hashes],
+            nome="notas_por_arquivo",
+        )
+        res = dict(cur.fetchall())
+        cur.close()
+        return res
+
+    @perf.timed("db.get_archived_documents")
+    @_leitura
+    def get_archived_documents(self):
+        """Notas e reembolsos da casa com original arquivado, mais recentes primeiro."""
+        cur = self._get_cursor(dict_rows=True)
+        self._execute(
+            cur,
+            """
+            SELECT 'nota' AS tipo, n.id, n.data_compra AS data, n.loja AS descricao, n.total_nota AS total,
+                   n.arquivo_hash AS hash, a.nome, a.tamanho, LENGTH(a.conteudo) AS comprimido,
+                   (SELECT COUNT(*) FROM itens i WHERE i.nota_id = n.id) AS n_itens
+            FROM notas n JOIN arquivos a ON a.hash = n.arquivo_hash
+            WHERE n.household_id = %s
+            UNION ALL
+            SELECT 'comprovante', r.id, r.data_pagamento, r.pagador || ' -> ' || r.recebedor, r.valor,
+                   r.comprovante, a.nome, a.tamanho, LENGTH(a.conteudo), NULL
+            FROM reembolsos r JOIN arquivos a ON a.hash = r.comprovante
+            WHERE r.household_id = %s
+            ORDER BY data DESC
+            """,
+            (self.household_id, self.household_id),
+            nome="documentos_arquivados",
+        )
+        res = cur.fetchall()
+        cur.close()
+        return [dict(row) for row in res]
+
+    # --- REGRAS DE DIVISÃO ---
+    def _load_rules(self, cur):
+        self._execute(
+            cur,
+            "SELECT id, campo, padrao, pesos, prioridade FROM regras_divisao WHERE household_id = %s ORDER BY prioridade DESC, id",
+            (self.household_id,),
+        )
+        colunas = [c[0] for c in cur.description]
+        return [SplitRule.from_row(dict(zip(colunas, row))) for row in cur.fetchall()]
+
+    @perf.timed("db.get_split_rules")
+    @_leitura
+    def get_split_rules(self):
+        cur = self._get_cursor()
+        regras = self._load_rules(cur)
+        cur.close()
+        return regras
+
+    def _resplit(self, cur, afetadas):
+        # Um único upsert set-based em item_shares sobre os itens afetados, com as regras atuais
+        self._execute(
+            cur,
+            "SELECT id, nome FROM participants WHERE household_id = %s ORDER BY id",
+            (self.household_id,),
+        )
+        participantes = [tuple(row) for row in cur.fetchall()]
+        comando = resplit_sql(self._load_rules(cur), participantes, self.household_id, afetadas)
+        if comando:
+            self._execute(cur, *comando)
+
+    @perf.timed("db.save_split_rule")
+    def save_split_rule(self, regra):
+        """Cria (regra.id None) ou altera uma regra e redivide o histórico afetado."""
+        cur = self._get_cursor()
+        try:
+            afetadas = [regra]
+            if regra.id is None:
+                self._execute(
+                    cur,
+                    "INSERT INTO regras_divisao (household_id, campo, padrao, pesos, prioridade) VALUES (%s, %s, %s, %s, %s) RETURNING id;",
+                    (self.household_id,) + regra.to_row(),
+                )
+                regra.id = cur.fetchone()[0]
+            else:
+                self._execute(cur, "SELECT id, campo, padrao, pesos, prioridade FROM regras_divisao WHERE id = %s", (regra.id,))
+                colunas = [c[0] for c in cur.description]
+                antiga = cur.fetchone()
+                if antiga:
+                    # Itens que batiam com a versão antiga também precisam ser refeitos
+                    afetadas.append(SplitRule.from_row(dict(zip(colunas, antiga))))
+                self._execute(
+                    cur,
+                    "UPDATE regras_divisao SET campo = %s, padrao = %s, pesos = %s, prioridade = %s WHERE id = %s",
+                    regra.to_row() + (regra.id,),
+                )
+            self._resplit(cur, afetadas)
+            self.conn.commit()
+            cur.close()
+            return True
+        except Exception as e:
+            self._rollback()
+            cur.close()
+            print(f"Erro SQL: {e}")
+            return False
+
+    @perf.timed("db.delete_split_rule")
+    def delete_split_rule(self, regra):
+        cur = self._get_cursor()
+        try:
+            self._execute(cur, "DELETE FROM regras_divisao WHERE id = %s", (regra.id,))
+            self._resplit(cur, [regra])
+            self.conn.commit()
+            cur.close()
+            return True
+        except Exception as e:
+            self._rollback()
+            cur.close()
+            print(f"Erro SQL: {e}")
+            return False
+
     # --- LEITURA DE DADOS ---
+    @perf.timed("db.get_balances")
+    @_leitura
+    def get_balances(self):
+        """
+        Balanço por participante numa query agrupada: consumo (soma das partes),
+        pago na loja, Pix enviado e Pix recebido.
+        saldo > 0: tem a receber; saldo < 0: deve.
+        """
+        cur = self._get_cursor(dict_rows=True)
+        self._prepared(
+            cur,
+            "balanco",
+            """
+            SELECT p.id, p.nome,
+                   COALESCE(c.consumo, 0) AS consumo,
+                   COALESCE(l.pago_loja, 0) AS pago_loja,
+                   COALESCE(e.pix_enviado, 0) AS pix_enviado,
+                   COALESCE(r.pix_recebido, 0) AS pix_recebido
+            FROM participants p
+            LEFT JOIN (
+                SELECT s.participant_id, SUM(s.amount) AS consumo
+                FROM item_shares s JOIN participants pp ON pp.id = s.participant_id
+                WHERE pp.household_id = %s
+                GROUP BY s.participant_id
+            ) c ON c.participant_id = p.id
+            LEFT JOIN (
+                SELECT n.pagador, SUM(i.valor) AS pago_loja
+                FROM notas n JOIN itens i ON i.nota_id = n.id
+                WHERE n.household_id = %s
+                GROUP BY n.pagador
+            ) l ON l.pagador = p.nome
+            LEFT JOIN (
+                SELECT pagador, SUM(valor) AS pix_enviado
+                FROM reembolsos WHERE household_id = %s
+                GROUP BY pagador
+            ) e ON e.pagador = p.nome
+            LEFT JOIN (
+                SELECT recebedor, SUM(valor) AS pix_recebido
+                FROM reembolsos WHERE household_id = %s
+                GROUP BY recebedor
+            ) r ON r.recebedor = p.nome
+            WHERE p.household_id = %s
+            ORDER BY p.id
+            """,
+            (self.household_id,) * 5,
+        )
+        res = [dict(row) for row in cur.fetchall()]
+        cur.close()
+        for row in res:
+            row["desembolso"] = row["pago_loja"] + row["pix_enviado"]
+            row["saldo"] = row["desembolso"] - row["pix_recebido"] - row["consumo"]
+        return res
+
+    @perf.timed("db.get_category_shares")
+    @_leitura
+    def get_category_shares(self, data_inicio=None, data_fim=None, loja=None):
+        """Consumo por categoria e participante (query agrupada), com filtros opcionais."""
+        filtros, params = ["n.household_id = %s"], [self.household_id]
+        if data_inicio:
+            filtros.append("n.data_compra >= %s")
+            params.append(data_inicio.isoformat())
+        if data_fim:
+            filtros.append("n.data_compra <= %s")
+            params.append(data_fim.isoformat())
+        if loja:
+            filtros.append("n.loja = %s")
+            params.append(loja)
+        return self._read_sql(
+            f"""
+            SELECT i.categoria, p.nome AS participante, SUM(s.amount) AS valor
+            FROM notas n
+            JOIN itens i ON i.nota_id = n.id
+            JOIN item_shares s ON s.item_id = i.id
+            JOIN participants p ON p.id = s.participant_id
+            WHERE {' AND '.join(filtros)}
+            GROUP BY i.categoria, p.nome
+            ORDER BY i.categoria, p.nome
+            """,
+            params,
+        )
+
+    @perf.timed("db.get_financial_data")
+    @_leitura
     def get_financial_data(self):
+        """Itens da casa, com a parte de cada participante numa coluna com o nome dele."""
         query_notas = """
-            SELECT n.id as nota_id, n.data_compra, n.loja, n.pagador, n.forma_pagamento,
-                i.item_nome, i.categoria, i.valor, i.kristian_parte, i.giulia_parte
+            SELECT n.id as nota_id, i.id as item_id, n.data_compra, n.loja, n.pagador, n.forma_pagamento,
+                i.item_nome, i.categoria, i.valor
             FROM notas n JOIN itens i ON n.id = i.nota_id
+            WHERE n.household_id = %s
+        """
+        query_partes = """
+            SELECT s.item_id, p.nome, s.amount
+            FROM item_shares s JOIN participants p ON p.id = s.participant_id
+            WHERE p.household_id = %s
         """
-        # Pandas lê direto do Postgres se tiver a conexão
-        df_compras = pd.read_sql_query(query_notas, self.conn)
-        df_reembolsos = pd.read_sql_query("SELECT * FROM reembolsos", self.conn)
+        # Pandas lê direto do banco a partir da conexão
+        df_compras = self._read_sql(query_notas, (self.household_id,), nome="itens_casa")
+        df_partes = self._read_sql(query_partes, (self.household_id,), nome="partes_casa")
+        if not df_partes.empty:
+            df_partes = df_partes.pivot_table(index="item_id", columns="nome", values="amount", aggfunc="sum")
+            df_compras = df_compras.merge(df_partes, left_on="item_id", right_index=True, how="left")
+        nomes = [p["nome"] for p in self.get_participants()]
+        for nome in nomes:
+            if nome not in df_compras.columns:
+                df_compras[nome] = 0.0
+        df_compras[nomes] = df_compras[nomes].fillna(0.0)
+        df_compras = df_compras[[c for c in df_compras.columns if c not in nomes] + nomes]
+
+        df_reembolsos = self._read_sql(
+            "SELECT * FROM reembolsos WHERE household_id = %s", (self.household_id,), nome="reembolsos_casa"
+        )
         return df_compras, df_reembolsos
-    
+
+    # --- BUSCA ---
+    @perf.timed("db.search_items")
+    @_leitura
+    def search_items(self, texto, pagina=0, por_pagina=search.POR_PAGINA):
+        """
+        Uma página de itens que batem com a busca, com o contexto da nota.
+        Retorna (DataFrame, total de acertos); (None, 0) se a busca está vazia.
+        """
+        comando = search.search_sql(self.backend.name, texto, self.household_id, pagina, por_pagina)
+        if comando is None:
+            return None, 0
+        df = self._read_sql(*comando)
+        total = int(df["total"].iloc[0]) if not df.empty else 0
+        return df.drop(columns=["total"]), total
+
+    # --- HISTÓRICO DE PREÇOS ---
+    @perf.timed("db.search_products")
+    @_leitura
+    def search_products(self, termo="", limite=50):
+        """Produtos da casa com histórico de preço, os mais comprados primeiro."""
+        return self._read_sql(
+            """
+            SELECT product_key, MAX(item_nome) AS item_nome, COUNT(*) AS compras,
+                   COUNT(DISTINCT loja) AS lojas, MAX(data_compra) AS ultima_compra
+            FROM v_precos
+            WHERE household_id = %s AND product_key LIKE %s
+            GROUP BY product_key
+            ORDER BY COUNT(*) DESC, product_key
+            LIMIT %s
+            """,
+            (self.household_id, f"%{product_key(termo)}%", limite),
+        )
+
+    @perf.timed("db.get_price_history")
+    @_leitura
+    def get_price_history(self, chave):
+        """
+        Série de preço de um produto: preço médio ponderado pela quantidade
+        (valor / qtd) por data, loja e unidade. Usa o índice (product_key, data_compra).
+        """
+        return self._read_sql(
+            """
+            SELECT data_compra, loja, un,
+                   SUM(valor) / SUM(qtd) AS preco_unitario,
+                   SUM(qtd) AS qtd, SUM(valor) AS valor
+            FROM v_precos
+            WHERE product_key = %s AND household_id = %s
+            GROUP BY data_compra, loja, un
+            ORDER BY data_compra, loja
+            """,
+            (chave, self.household_id),
+        )
+
+    @perf.timed("db.get_store_price_comparison")
+    @_leitura
+    def get_store_price_comparison(self, chave):
+        """Comparação entre lojas de um produto: médio, mínimo, máximo e última compra."""
+        return self._read_sql(
+            """
+            SELECT loja, un,
+                   SUM(valor) / SUM(qtd) AS preco_medio,
+                   MIN(vl_unit) AS preco_min,
+                   MAX(vl_unit) AS preco_max,
+                   COUNT(*) AS compras,
+                   MAX(data_compra) AS ultima_compra
+            FROM v_precos
+            WHERE product_key = %s AND household_id = %s
+            GROUP BY loja, un
+            ORDER BY preco_medio
+            """,
+            (chave, self.household_id),
+        )
+
+    @perf.timed("db.get_all_invoices")
+    @_leitura
     def get_all_invoices(self):
-        cur = self._get_cursor() # Usa cursor de dicionário
-        cur.execute("SELECT id, data_compra, loja, total_nota, pagador FROM notas ORDER BY data_compra DESC")
+        cur = self._get_cursor(dict_rows=True) # Usa cursor de dicionário
+        self._prepared(
+            cur,
+            "listar_notas",
+            "SELECT id, data_compra, loja, total_nota, pagador FROM notas WHERE household_id = %s ORDER BY data_compra DESC",
+            (self.household_id,),
+        )
         res = cur.fetchall()
         cur.close()
-        # Converte para lista de dicts puros se necessário, mas RealDictCursor já ajuda
+        # Converte para lista de dicts puros se necessário
         return [dict(row) for row in res]
 
+    @perf.timed("db.get_all_reimbursements")
+    @_leitura
     def get_all_reimbursements(self):
-        cur = self._get_cursor()
-        cur.execute("SELECT id, data_pagamento, pagador, recebedor, valor FROM reembolsos ORDER BY data_pagamento DESC")
+        cur = self._get_cursor(dict_rows=True)
+        self._prepared(
+            cur,
+            "listar_reembolsos",
+            "SELECT id, data_pagamento, pagador, recebedor, valor FROM reembolsos WHERE household_id = %s ORDER BY data_pagamento DESC",
+            (self.household_id,),
+        )
         res = cur.fetchall()
         cur.close()
         return [dict(row) for row in res]
 
     # --- DELETAR ---
+    @perf.timed("db.delete_invoice")
     def delete_invoice(self, note_id):
-        cur = self.conn.cursor()
+        cur = self._get_cursor()
         try:
-            # No Postgres, se configurarmos ON DELETE CASCADE na chave estrangeira,
-            # apagar a nota apaga os itens automaticamente. Mas vamos garantir:
-            cur.execute("DELETE FROM itens WHERE nota_id = %s", (note_id,))
-            cur.execute("DELETE FROM notas WHERE id = %s", (note_id,))
+            # Com ON DELETE CASCADE nas chaves estrangeiras, apagar a nota
+            # apaga itens e partes automaticamente. Mas vamos garantir:
+            self._execute(
+                cur,
+                "DELETE FROM item_shares WHERE item_id IN (SELECT id FROM itens WHERE nota_id = %s)",
+                (note_id,),
+            )
+            self._execute(cur, "DELETE FROM itens WHERE nota_id = %s", (note_id,))
+            self._execute(cur, "DELETE FROM notas WHERE id = %s", (note_id,))
             self.conn.commit()
             cur.close()
             return True
         except:
-            self.conn.rollback()
+            self._rollback()
             cur.close()
             return False
 
+    @perf.timed("db.delete_reimbursement")
     def delete_reimbursement(self, reimb_id):
-        cur = self.conn.cursor()
+        cur = self._get_cursor()
         try:
-            cur.execute("DELETE FROM reembolsos WHERE id = %s", (reimb_id,))
+            self._execute(cur, "DELETE FROM reembolsos WHERE id = %s", (reimb_id,))
             self.conn.commit()
             cur.close()
             return True
         except:
-            self.conn.rollback()
+            self._rollback()
             cur.close()
             return False
 
+    @perf.timed("db.close")
     def close(self):
 
-        self.conn.close()
+        self._finalizer()
@@ -0,0 +1,359 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from datetime import datetime
+
+import perf
+
+# Índice da fila de notas pendentes.
+# Cada upload é registrado (e lido uma única vez) aqui, então a tela da fila
+# lista/ordena/filtra sem abrir nenhum PDF e o processador reaproveita o
+# resultado do parser em vez de reler o arquivo a cada rerun.
+# Várias pessoas revisam a fila ao mesmo tempo: cada sessão reserva a nota
+# que está editando (reservado_por + prazo), e a reserva é tomada dentro de
+# um BEGIN IMMEDIATE, então duas sessões nunca pegam a mesma nota.
+# Cada casa tem a sua fila: o índice é um só, mas toda operação filtra pelo
+# household_id, e os arquivos ficam numa subpasta por casa (a casa 1 usa a
+# raiz, onde já estavam os arquivos de antes da divisão por casa).
+
+MANIFEST_FILE = "manifest.sqlite"
+EXTENSOES = (".pdf", ".xml")
+RESERVA_SEGUNDOS = 10 * 60  # reserva renovada a cada rerun; expira se a aba for fechada
+
+# Nota que a sessão pode pegar: livre, já dela ou com a reserva vencida
+_DISPONIVEL = "(reservado_por IS NULL OR reservado_por = ? OR reservado_ate < ?)"
+
+
+class QueueManifest:
+    def __init__(self, buffer_dir, household_id=1):
+        self.buffer_dir = buffer_dir
+        self.household_id = household_id
+        self.path = os.path.join(buffer_dir, MANIFEST_FILE)
+        # Caminho dos arquivos desta casa, relativo a buffer_dir ("" = raiz)
+        self.pasta = "" if household_id == 1 else f"casa_{household_id}"
+        os.makedirs(os.path.join(buffer_dir, self.pasta), exist_ok=True)
+        self._create_tables()
+
+    def _connect(self):
+        # Uma conexão por operação: várias sessões do Streamlit usam o mesmo arquivo
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _create_tables(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS fila (
+                    arquivo TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL UNIQUE,
+                    tamanho INTEGER NOT NULL,
+                    enviado_em TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pendente',
+                    erro TEXT,
+                    loja TEXT,
+                    data TEXT,
+                    total REAL,
+                    pagador TEXT,
+                    n_itens INTEGER,
+                    dados TEXT,
+                    reservado_por TEXT,
+                    reservado_ate REAL,
+                    household_id INTEGER NOT NULL DEFAULT 1
+                );
+            """)
+            # Manifesto criado antes da reserva por sessão / da fila por casa
+            colunas = {r["name"] for r in conn.execute("PRAGMA table_info(fila)")}
+            if "reservado_por" not in colunas:
+                conn.execute("ALTER TABLE fila ADD COLUMN reservado_por TEXT")
+                conn.execute("ALTER TABLE fila ADD COLUMN reservado_ate REAL")
+            if "household_id" not in colunas:
+                conn.execute("ALTER TABLE fila ADD COLUMN household_id INTEGER NOT NULL DEFAULT 1")
+            conn.execute("DROP INDEX IF EXISTS idx_fila_enviado")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_fila_household_enviado ON fila (household_id, enviado_em);")
+
+    @contextmanager
+    def _write_lock(self):
+        """
+        Transação que já começa com a trava de escrita (BEGIN IMMEDIATE):
+        o que for lido dentro dela não muda até o COMMIT.
+        """
+        conn = self._connect()
+        conn.isolation_level = None  # controle manual da transação
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def path_for(self, arquivo):
+        return os.path.join(self.buffer_dir, arquivo)
+
+    # --- ENTRADA NA FILA ---
+    @perf.timed("manifest.add")
+    def add(self, nome, conteudo):
+        """
+        Grava o upload na pasta da casa e registra no índice.
+        Retorna o nome final do arquivo (relativo à pasta da fila), ou None se o
+        mesmo conteúdo já está na fila, desta ou de outra casa: um cupom é uma compra só.
+        """
+        hash_arquivo = hashlib.sha256(conteudo).hexdigest()
+        # Checagem, gravação e INSERT sob a trava de escrita: dois uploads
+        # simultâneos do mesmo arquivo não passam os dois pela checagem
+        arquivo = None
+        try:
+            with self._write_lock() as conn:
+                if conn.execute("SELECT 1 FROM fila WHERE hash = ?", (hash_arquivo,)).fetchone():
+                    return None
+
+                base = os.path.basename(nome)
+                arquivo = os.path.join(self.pasta, base)
+                if os.path.exists(self.path_for(arquivo)):
+                    # Mesmo nome, conteúdo diferente: prefixa com o começo do hash
+                    arquivo = os.path.join(self.pasta, f"{hash_arquivo[:8]}_{base}")
+                    if os.path.exists(self.path_for(arquivo)):
+                        # Mesma cópia já na pasta, ainda não registrada pelo sync()
+                        return None
+
+                with open(self.path_for(arquivo), "wb") as buffer:
+                    buffer.write(conteudo)
+
+                conn.execute(
+                    "INSERT INTO fila (arquivo, hash, tamanho, enviado_em, household_id) VALUES (?, ?, ?, ?, ?)",
+                    (arquivo, hash_arquivo, len(conteudo), datetime.now().isoformat(sep=" ", timespec="seconds"),
+                     self.household_id),
+                )
+        except sqlite3.IntegrityError:
+            # Registrado por outro caminho nesse meio tempo: é duplicata
+            try:
+                os.remove(self.path_for(arquivo))
+            except FileNotFoundError:
+                pass
+            return None
+        return arquivo
+
+    @perf.timed("manifest.index")
+    def index(self, arquivo, parse_func, payer_func):
+        """
+        Lê a nota uma vez e guarda cabeçalho + resultado completo do parser.
+        parse_func(caminho) -> dict do parser; payer_func(cpf) -> palpite de pagador.
+        """
+        try:
+            dados = parse_func(self.path_for(arquivo))
+        except Exception as e:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "UPDATE fila SET status = 'erro', erro = ? WHERE arquivo = ?",
+                    (str(e), arquivo),
+                )
+            return None
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                UPDATE fila SET status = 'ok', erro = NULL, loja = ?, data = ?, total = ?,
+                                pagador = ?, n_itens = ?, dados = ?
+                WHERE arquivo = ?
+                """,
+                (
+                    dados.get("loja"),
+                    dados.get("data"),
+                    round(dados.get("total_nota") or 0.0, 2),
+                    payer_func(dados.get("cpf_consumidor")),
+                    len(dados.get("itens", [])),
+                    json.dumps(dados),
+                    arquivo,
+                ),
+            )
+        return dados
+
+    # --- LEITURA ---
+    @perf.timed("manifest.entries")
+    def entries(self, sessao=None):
+        """
+        Entradas da fila da casa (sem o JSON completo), mais antigas primeiro.
+        em_uso = 1 se a nota está reservada por outra sessão.
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"""
+                SELECT arquivo, hash, tamanho, enviado_em, status, erro, loja, data, total, pagador, n_itens,
+                       NOT {_DISPONIVEL} AS em_uso
+                FROM fila WHERE household_id = ? ORDER BY enviado_em, arquivo
+                """,
+                (sessao, time.time(), self.household_id),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def get_parsed(self, arquivo):
+        """Resultado do parser guardado no upload (None se ainda não indexado)."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT dados FROM fila WHERE arquivo = ? AND status = 'ok'", (arquivo,)
+            ).fetchone()
+        return json.loads(row["dados"]) if row and row["dados"] else None
+
+    @perf.timed("manifest.get_parsed_many")
+    def get_parsed_many(self, arquivos):
+        """get_parsed de várias notas numa consulta só: {arquivo: dados}."""
+        if not arquivos:
+            return {}
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT arquivo, dados FROM fila WHERE status = 'ok' AND arquivo IN ({', '.join('?' * len(arquivos))})",
+                list(arquivos),
+            ).fetchall()
+        return {r["arquivo"]: json.loads(r["dados"]) for r in rows if r["dados"]}
+
+    # --- RESERVA POR SESSÃO ---
+    @perf.timed("manifest.claim")
+    def claim(self, sessao, preferida=None):
+        """
+        Reserva (ou renova) uma nota para a sessão e solta as outras que ela tinha.
+        Fica com a preferida se ela estiver disponível; senão, a mais antiga disponível.
+        Retorna o arquivo reservado, ou None se não sobrou nota livre.
+        """
+        agora = time.time()
+        with self._write_lock() as conn:
+            row = None
+            if preferida:
+                row = conn.execute(
+                    f"SELECT arquivo FROM fila WHERE arquivo = ? AND household_id = ? AND {_DISPONIVEL}",
+                    (preferida, self.household_id, sessao, agora),
+                ).fetchone()
+            if row is None:
+                row = conn.execute(
+                    f"""
+                    SELECT arquivo FROM fila WHERE household_id = ? AND {_DISPONIVEL}
+                    ORDER BY reservado_por IS ? DESC, enviado_em, arquivo LIMIT 1
+                    """,
+                    (self.household_id, sessao, agora, sessao),
+                ).fetchone()
+            if row is None:
+                return None
+
+            arquivo = row["arquivo"]
+            conn.execute(
+                "UPDATE fila SET reservado_por = NULL, reservado_ate = NULL WHERE reservado_por = ? AND arquivo <> ?",
+                (sessao, arquivo),
+            )
+            conn.execute(
+                "UPDATE fila SET reservado_por = ?, reservado_ate = ? WHERE arquivo = ?",
+                (sessao, agora + RESERVA_SEGUNDOS, arquivo),
+            )
+        return arquivo
+
+    @perf.timed("manifest.claim_many")
+    def claim_many(self, sessao, arquivos):
+        """
+        Reserva de uma vez as notas disponíveis entre arquivos (revisão em lote).
+        Retorna as que ficaram com a sessão; as de outras sessões ficam de fora.
+        """
+        if not arquivos:
+            return []
+        agora = time.time()
+        marcadores = ", ".join("?" * len(arquivos))
+        with self._write_lock() as conn:
+            conn.execute(
+                f"""
+                UPDATE fila SET reservado_por = ?, reservado_ate = ?
+                WHERE arquivo IN ({marcadores}) AND household_id = ? AND {_DISPONIVEL}
+                """,
+                [sessao, agora + RESERVA_SEGUNDOS, *arquivos, self.household_id, sessao, agora],
+            )
+            rows = conn.execute(
+                f"SELECT arquivo FROM fila WHERE reservado_por = ? AND household_id = ? AND arquivo IN ({marcadores})",
+                [sessao, self.household_id, *arquivos],
+            ).fetchall()
+        obtidas = {r["arquivo"] for r in rows}
+        return [a for a in arquivos if a in obtidas]
+
+    def release(self, sessao):
+        """Devolve à fila as notas reservadas pela sessão."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE fila SET reservado_por = NULL, reservado_ate = NULL WHERE reservado_por = ?", (sessao,)
+            )
+
+    # --- SAÍDA DA FILA ---
+    @perf.timed("manifest.remove")
+    def remove(self, arquivo, sessao=None):
+        """
+        Tira a nota da fila e apaga o arquivo.
+        Com sessao, só remove se a nota não estiver reservada por outra sessão.
+        Retorna False se a nota já tinha saído da fila (ou é de outra sessão ou casa).
+        """
+        with self._write_lock() as conn:
+            if sessao is None:
+                cur = conn.execute(
+                    "DELETE FROM fila WHERE arquivo = ? AND household_id = ?", (arquivo, self.household_id)
+                )
+            else:
+                cur = conn.execute(
+                    f"DELETE FROM fila WHERE arquivo = ? AND household_id = ? AND {_DISPONIVEL}",
+                    (arquivo, self.household_id, sessao, time.time()),
+                )
+            removida = cur.rowcount > 0
+        if removida:
+            try:
+                os.remove(self.path_for(arquivo))
+            except FileNotFoundError:
+                # Apagado por fora (ou por outra sessão, antes da reserva existir)
+                pass
+        return removida
+
+    @perf.timed("manifest.sync")
+    def sync(self):
+        """
+        Reconcilia o índice da casa com a pasta dela (arquivos copiados à mão ou apagados por fora).
+        Retorna a lista de arquivos novos, que ainda precisam de index().
+        """
+        no_disco = {
+            os.path.join(self.pasta, f)
+            for f in os.listdir(os.path.join(self.buffer_dir, self.pasta))
+            if f.lower().endswith(EXTENSOES)
+        }
+        with closing(self._connect()) as conn, conn:
+            no_indice = {
+                r["arquivo"]
+                for r in conn.execute("SELECT arquivo FROM fila WHERE household_id = ?", (self.household_id,))
+            }
+            for arquivo in no_indice - no_disco:
+                conn.execute("DELETE FROM fila WHERE arquivo = ?", (arquivo,))
+
+        novos = []
+        for arquivo in sorted(no_disco - no_indice):
+            try:
+                with open(self.path_for(arquivo), "rb") as f:
+                    conteudo = f.read()
+            except FileNotFoundError:
+                # Outra sessão salvou a nota enquanto a pasta era listada
+                continue
+            hash_arquivo = hashlib.sha256(conteudo).hexdigest()
+            with self._write_lock() as conn:
+                if conn.execute("SELECT 1 FROM fila WHERE arquivo = ?", (arquivo,)).fetchone():
+                    # Registrado por add() depois da listagem da pasta
+                    continue
+                if conn.execute("SELECT 1 FROM fila WHERE hash = ?", (hash_arquivo,)).fetchone():
+                    # Cópia de uma nota que já está na fila
+                    try:
+                        os.remove(self.path_for(arquivo))
+                    except FileNotFoundError:
+                        pass
+                    continue
+                enviado_em = datetime.fromtimestamp(os.path.getmtime(self.path_for(arquivo)))
+                conn.execute(
+                    "INSERT INTO fila (arquivo, hash, tamanho, enviado_em, household_id) VALUES (?, ?, ?, ?, ?)",
+                    (arquivo, hash_arquivo, len(conteudo), enviado_em.isoformat(sep=" ", timespec="seconds"),
+                     self.household_id),
+                )
+            novos.append(arquivo)
+        return novos
@@ -1,11 +1,116 @@
-import pdfplumber
+import io
+import multiprocessing
+import os
 import re
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from decimal import Decimal
+
+import perf
+import templates
+
+# Extração paralela das páginas (notas de atacado com 6-10 páginas).
+# O pdfplumber é Python puro e segura o GIL, então o paralelismo é por processo:
+# cada processo auxiliar abre o PDF e devolve o texto de um bloco de páginas.
+# O pool é criado na primeira nota longa e reaproveitado pelas seguintes.
+# Opcional (PARSER_WORKERS, padrão 1 = desligado): o ganho depende de haver
+# CPUs livres no servidor; sem elas, a extração sequencial é tão rápida quanto.
+PARALELO_MIN_PAGINAS = 4  # abaixo disso abrir o PDF em outro processo não compensa
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers < workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn: o servidor do Streamlit tem várias threads, e fork com threads não é seguro
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+    return _pool
+
+
+def _discard_pool(pool):
+    # Pool quebrado não se recupera: tira do módulo para a próxima nota longa criar outro
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+            _pool_workers = 0
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _extract_pages(origem, indices):
+    """Roda no processo auxiliar: texto (layout=True) das páginas pedidas, na ordem."""
+    import pdfplumber
+
+    if isinstance(origem, bytes):
+        origem = io.BytesIO(origem)
+    with pdfplumber.open(origem) as pdf:
+        return [pdf.pages[i].extract_text(layout=True) or "" for i in indices]
+
+
+def resolve_workers(workers, n_paginas):
+    """Processos para extrair n_paginas: 1 = sequencial, 0/None = um por CPU."""
+    if workers == 1 or n_paginas < PARALELO_MIN_PAGINAS:
+        return 1
+    workers = workers or os.cpu_count() or 1
+    return max(1, min(workers, n_paginas))
+
+
+def extract_pages_parallel(origem, indices, workers):
+    """
+    Texto das páginas indices, dividido em blocos contíguos entre os processos.
+    origem: caminho ou BytesIO (o processo auxiliar recebe os bytes).
+    """
+    if hasattr(origem, "getvalue"):
+        origem = origem.getvalue()
+    tamanho = -(-len(indices) // workers)
+    blocos = [indices[i:i + tamanho] for i in range(0, len(indices), tamanho)]
+    textos = []
+    pool = _get_pool(workers)
+    try:
+        # map devolve na ordem dos blocos, qualquer que seja o processo que termina antes
+        for parte in pool.map(_extract_pages, [origem] * len(blocos), blocos):
+            textos.extend(parte)
+    except BrokenProcessPool:
+        # Um processo auxiliar morreu (falta de memória, kill): lê aqui mesmo
+        _discard_pool(pool)
+        return _extract_pages(origem, indices)
+    return textos
+
 
 class InvoiceParser:
-    def __init__(self, pdf_path):
+    # Regexes do leitor genérico, compiladas uma vez só
+    RE_DATA = re.compile(r'(\d{2}/\d{2}/\d{4})')
+    RE_CPF = re.compile(r'(\d{3}\.\d{3}\.\d{3}-\d{2})')
+    RE_CPF_LINHA = re.compile(r'(?i)(CPF|CNPJ):?\s*[\d\.\/-]{11,18}')
+    RE_DESCONTO = re.compile(r'(?:DESCONTOS?|DESC\.?|R\$).+?(\d+,\d{2})', re.IGNORECASE)
+    RE_DOIS_PRECOS = re.compile(r'\d+,\d{2}\s+\d+,\d{2}\s*$') # Termina com dois preços?
+    RE_PROTOCOLO = re.compile(r'(?i)Protocolo.*?\d+')
+    RE_CHAVE_ACESSO = re.compile(r'(?:\d{4}\s?){11}')
+    RE_NUMERO_LETRA = re.compile(r'(\d)([a-zA-Z])')
+    RE_LETRA_NUMERO = re.compile(r'([a-zA-Z])(\d)')
+    RE_ITEM_COMPLETO = re.compile(r'(\d+(?:,\d+)?)\s+([a-zA-Z]{2,3})\s+(\d+(?:,\d+)?)\s+(\d+(?:,\d+)?)\s*$')
+    RE_SO_TOTAL = re.compile(r'(\d+,\d{2})\s*$')
+    RE_CODIGO = re.compile(r'^\d+\s+')
+
+    def __init__(self, pdf_path, workers=1):
         self.pdf_path = pdf_path
+        self.workers = workers  # processos na extração de texto (ver resolve_workers)
         self.raw_text = ""
-        self.data = {
+        self.template = None
+        self.data = self._empty_data()
+
+    @staticmethod
+    def _empty_data():
+        return {
             "loja": None,
             "data": None,
             "cpf_consumidor": None,
@@ -21,15 +126,145 @@ class InvoiceParser:
         except:
             return 0.0
 
+    def _read_metadata(self, line_clean, line_upper, data):
+        """
+        Metadados gerais (lidos em qualquer lugar da nota).
+        Retorna a linha sem o CPF/CNPJ e o desconto achado nela.
+        """
+        desconto = 0.0
+
+        # Data
+        if not data["data"]:
+            date_match = self.RE_DATA.search(line_clean)
+            if date_match:
+                data["data"] = date_match.group(1)
+
+        # Loja (Geralmente nas primeiras linhas)
+        if not data["loja"] and ("DISTRIBUIDORA" in line_upper or "SUPERMERCADO" in line_upper or "LTDA" in line_upper):
+            data["loja"] = line_clean
+
+        # CPF (Pega e limpa da linha) [cite: 16]
+        if "CPF" in line_upper or "CNPJ" in line_upper:
+            cpf_match = self.RE_CPF.search(line_clean)
+            if cpf_match: data["cpf_consumidor"] = cpf_match.group(1)
+            # Remove o CPF da linha para não sujar se estiver grudado no item
+            line_clean = self.RE_CPF_LINHA.sub('', line_clean).strip()
+
+        # Desconto (Pega e soma)
+        if "DESCONTO" in line_upper:
+            match_desc = self.RE_DESCONTO.search(line_clean)
+            if match_desc:
+                desconto = self._convert_br_number(match_desc.group(1))
+
+        # Forma de Pagamento (Geralmente no final)
+        if "CARTÃO" in line_upper or "CREDITO" in line_upper: data["forma_pagamento"] = "Cartão de Crédito"
+        elif "DEBITO" in line_upper: data["forma_pagamento"] = "Débito"
+        elif "PIX" in line_upper: data["forma_pagamento"] = "Pix"
+        elif "DINHEIRO" in line_upper: data["forma_pagamento"] = "Dinheiro"
+
+        return line_clean, desconto
+
+    @staticmethod
+    def _add_discount(data, desconto):
+        # Desconto entra como item negativo e o total é a soma dos itens
+        if desconto > 0:
+            data["itens"].append({
+                "item": "💸 DESCONTO / ABATIMENTO",
+                "qtd": 1, "un": "UN", "vl_unit": -desconto,
+                "valor": -desconto
+            })
+        data["total_nota"] = sum(item["valor"] for item in data["itens"])
+
+    @perf.timed("parser.parse")
     def parse(self):
+        # Import adiado: notas em XML e as demais telas não precisam do pdfplumber
+        import pdfplumber
+
         with pdfplumber.open(self.pdf_path) as pdf:
-            full_text = ""
-            for page in pdf.pages:
-                full_text += page.extract_text(layout=True) or "" 
-            self.raw_text = full_text
+            with perf.span("parser.extract_text"):
+                textos = {}
+                if pdf.pages:
+                    textos[0] = pdf.pages[0].extract_text(layout=True) or ""
+
+            # Layout conhecido? Leitor do modelo; se não fechar, cai no genérico
+            template, impressao = templates.match(textos.get(0, ""))
+            if template is not None:
+                with perf.span("parser.template"):
+                    data = self._parse_template(pdf, template, impressao, textos)
+                if data is not None:
+                    self.template = template.nome
+                    self.data = data
+                    return self.data
+
+            self._extract_rest(pdf, textos)
+            self.raw_text = self._stitch(textos)
+
+        self._parse_generic()
+        return self.data
+
+    def _extract_rest(self, pdf, textos):
+        """Completa textos ({página: texto}) com as páginas que faltam."""
+        faltando = [i for i in range(len(pdf.pages)) if i not in textos]
+        workers = resolve_workers(self.workers, len(faltando))
+        with perf.span("parser.extract_text"):
+            if workers > 1:
+                try:
+                    textos.update(zip(faltando, extract_pages_parallel(self.pdf_path, faltando, workers)))
+                    return
+                except Exception:
+                    # Pool quebrado (processo morto, sem permissão para criar processos):
+                    # segue no processo atual
+                    pass
+            for i in faltando:
+                textos[i] = pdf.pages[i].extract_text(layout=True) or ""
+
+    @staticmethod
+    def _stitch(textos):
+        # Páginas em ordem, com quebra de linha entre elas: a última linha de uma
+        # página não gruda na primeira da seguinte, e a linha pendente de um item
+        # quebrado no fim da página continua valendo para a próxima
+        return "\n".join(textos[i] for i in sorted(textos))
+
+    def _parse_template(self, pdf, template, impressao, textos):
+        """Leitura pelo modelo da loja. None se o resultado não bater com o total impresso."""
+        self._extract_rest(pdf, textos)
+        linhas = self._stitch(textos).split('\n')
+
+        itens = template.read_items(linhas)
+        if not itens:
+            return None
+
+        data = self._empty_data()
+        data["loja"] = template.loja or impressao.loja or None
+        desconto = 0.0
+        for line in linhas:
+            line_clean = line.strip()
+            if not line_clean: continue
+            _, achado = self._read_metadata(line_clean, line_clean.upper(), data)
+            desconto += achado
 
+        for nome, qtd, un, vl_unit, valor in itens:
+            data["itens"].append({
+                "item": nome,
+                "qtd": self._convert_br_number(qtd),
+                "un": un,
+                "vl_unit": self._convert_br_number(vl_unit),
+                "valor": self._convert_br_number(valor),
+            })
+
+        # Conferência: a soma dos itens tem que bater com o "Valor total" da nota
+        total_impresso = templates.printed_total(linhas)
+        if total_impresso is not None:
+            soma = sum(item["valor"] for item in data["itens"])
+            if abs(soma - self._convert_br_number(total_impresso)) > 0.01:
+                return None
+
+        self._add_discount(data, desconto)
+        return data
+
+    def _parse_generic(self):
         lines = self.raw_text.split('\n')
-        
+
         # --- ESTADOS DO LEITOR ---
         lendo_itens = False # Só vira True quando passar pelo cabeçalho
         linha_anterior_pendente = ""
@@ -43,34 +278,8 @@ class InvoiceParser:
             # ===============================================================
             # 1. METADADOS GERAIS (Lê em qualquer lugar da nota)
             # ===============================================================
-            
-            # Data
-            date_match = re.search(r'(\d{2}/\d{2}/\d{4})', line_clean)
-            if date_match and not self.data["data"]:
-                self.data["data"] = date_match.group(1)
-
-            # Loja (Geralmente nas primeiras linhas)
-            if not self.data["loja"] and ("DISTRIBUIDORA" in line_upper or "SUPERMERCADO" in line_upper or "LTDA" in line_upper):
-                self.data["loja"] = line_clean
-
-            # CPF (Pega e limpa da linha) [cite: 16]
-            if "CPF" in line_upper or "CNPJ" in line_upper:
-                cpf_match = re.search(r'(\d{3}\.\d{3}\.\d{3}-\d{2})', line_clean)
-                if cpf_match: self.data["cpf_consumidor"] = cpf_match.group(1)
-                # Remove o CPF da linha para não sujar se estiver grudado no item
-                line_clean = re.sub(r'(?i)(CPF|CNPJ):?\s*[\d\.\/-]{11,18}', '', line_clean).strip()
-
-            # Desconto (Pega e soma)
-            if "DESCONTO" in line_upper:
-                match_desc = re.search(r'(?:DESCONTOS?|DESC\.?|R\$).+?(\d+,\d{2})', line_clean, re.IGNORECASE)
-                if match_desc:
-                    acumulado_desconto += self._convert_br_number(match_desc.group(1))
-
-            # Forma de Pagamento (Geralmente no final)
-            if "CARTÃO" in line_upper or "CREDITO" in line_upper: self.data["forma_pagamento"] = "Cartão de Crédito"
-            elif "DEBITO" in line_upper: self.data["forma_pagamento"] = "Débito"
-            elif "PIX" in line_upper: self.data["forma_pagamento"] = "Pix"
-            elif "DINHEIRO" in line_upper: self.data["forma_pagamento"] = "Dinheiro"
+            line_clean, desconto = self._read_metadata(line_clean, line_upper, self.data)
+            acumulado_desconto += desconto
 
             # ===============================================================
             # 2. CONTROLE DE ESTADO (Onde começa e onde termina a lista?)
@@ -90,8 +299,7 @@ class InvoiceParser:
             # Se ainda não ativou o modo leitura (e não é cabeçalho explícito),
             # verifica se a linha JÁ É um item (caso o cabeçalho não tenha sido lido corretamente)
             # Isso é uma segurança caso o PDF não tenha o texto "Código Descrição" legível.
-            regex_item_check = r'\d+,\d{2}\s+\d+,\d{2}\s*$' # Termina com dois preços?
-            if not lendo_itens and re.search(regex_item_check, line_clean) and not "VALOR" in line_upper:
+            if not lendo_itens and not "VALOR" in line_upper and self.RE_DOIS_PRECOS.search(line_clean):
                 lendo_itens = True
 
             # ===============================================================
@@ -100,17 +308,16 @@ class InvoiceParser:
             
             if lendo_itens:
                 # Limpeza de lixo específico dentro da área de itens
-                line_clean = re.sub(r'(?i)Protocolo.*?\d+', '', line_clean).strip() # Protocolo
-                line_clean = re.sub(r'(?:\d{4}\s?){11}', '', line_clean).strip() # Chave de acesso [cite: 13]
+                line_clean = self.RE_PROTOCOLO.sub('', line_clean).strip() # Protocolo
+                line_clean = self.RE_CHAVE_ACESSO.sub('', line_clean).strip() # Chave de acesso [cite: 13]
                 
                 # Injeção de espaço (Desgrudar "0,500KG") 
-                line_clean = re.sub(r'(\d)([a-zA-Z])', r'\1 \2', line_clean)
-                line_clean = re.sub(r'([a-zA-Z])(\d)', r'\1 \2', line_clean)
+                line_clean = self.RE_NUMERO_LETRA.sub(r'\1 \2', line_clean)
+                line_clean = self.RE_LETRA_NUMERO.sub(r'\1 \2', line_clean)
 
                 # Regex do Item: Pega do FIM para o COMEÇO
                 # Qtd -> Un -> Unit -> Total
-                regex_completo = r'(\d+(?:,\d+)?)\s+([a-zA-Z]{2,3})\s+(\d+(?:,\d+)?)\s+(\d+(?:,\d+)?)\s*$'
-                match = re.search(regex_completo, line_clean)
+                match = self.RE_ITEM_COMPLETO.search(line_clean)
                 
                 item_data = {}
 
@@ -124,21 +331,22 @@ class InvoiceParser:
                     # Nome é o que sobrou no começo
                     texto_nome = line_clean[:match.start()].strip()
                     # Remove o CÓDIGO numérico inútil do início (ex: "6675") 
-                    texto_nome = re.sub(r'^\d+\s+', '', texto_nome).strip()
+                    texto_nome = self.RE_CODIGO.sub('', texto_nome).strip()
                     
                     item_data = {"item": texto_nome, "qtd": qtd, "un": un, "vl_unit": vl_unit, "valor": vl_total}
 
-                elif re.search(r'(\d+,\d{2})\s*$', line_clean):
-                    # Achou só o total (item quebrado)
-                    match_total = re.search(r'(\d+,\d{2})\s*$', line_clean)
-                    vl_total = self._convert_br_number(match_total.group(1))
-                    
-                    texto_nome = line_clean[:match_total.start()].strip()
-                    texto_nome = re.sub(r'^\d+\s+', '', texto_nome).strip()
-                    
-                    # Se tiver texto suficiente, é item
-                    if len(texto_nome) > 2:
-                        item_data = {"item": texto_nome, "qtd": 1.0, "un": "UN", "vl_unit": vl_total, "valor": vl_total}
+                else:
+                    match_total = self.RE_SO_TOTAL.search(line_clean)
+                    if match_total:
+                        # Achou só o total (item quebrado)
+                        vl_total = self._convert_br_number(match_total.group(1))
+                        
+                        texto_nome = line_clean[:match_total.start()].strip()
+                        texto_nome = self.RE_CODIGO.sub('', texto_nome).strip()
+                        
+                        # Se tiver texto suficiente, é item
+                        if len(texto_nome) > 2:
+                            item_data = {"item": texto_nome, "qtd": 1.0, "un": "UN", "vl_unit": vl_total, "valor": vl_total}
 
                 # Salva ou Junta com anterior
                 if item_data:
@@ -153,12 +361,118 @@ class InvoiceParser:
                         linha_anterior_pendente = line_clean
 
         # --- FIM DO LOOP: Adiciona o Desconto como Item ---
-        if acumulado_desconto > 0:
+        self._add_discount(self.data, acumulado_desconto)
+        return self.data
+
+
+class XmlInvoiceParser:
+    """
+    Leitor do XML da SEFAZ (nfeProc/NFe, modelos 55 e 65).
+    Devolve o mesmo dicionário do InvoiceParser, com valores exatos do XML.
+    Lê em streaming (iterparse) e descarta cada <det> depois de usado.
+    """
+
+    # Códigos de tPag (Manual de Orientação do Contribuinte)
+    FORMAS_PAGAMENTO = {
+        "01": "Dinheiro",
+        "03": "Cartão de Crédito",
+        "04": "Débito",
+        "17": "Pix",
+    }
+
+    def __init__(self, xml_path):
+        self.xml_path = xml_path
+        self.data = {
+            "loja": None,
+            "data": None,
+            "cpf_consumidor": None,
+            "forma_pagamento": "Indefinido",
+            "total_nota": 0.0,
+            "itens": [] # Desconto entrará aqui como negativo
+        }
+
+    @staticmethod
+    def _tag(elem):
+        # "{http://www.portalfiscal.inf.br/nfe}xProd" -> "xProd"
+        return elem.tag.rsplit("}", 1)[-1]
+
+    @staticmethod
+    def _filhos(elem):
+        return {XmlInvoiceParser._tag(c): (c.text or "").strip() for c in elem}
+
+    @staticmethod
+    def _formata_cpf(cpf):
+        if len(cpf) != 11:
+            return cpf
+        return f"{cpf[:3]}.{cpf[3:6]}.{cpf[6:9]}-{cpf[9:]}"
+
+    @perf.timed("parser.parse_xml")
+    def parse(self):
+        desconto_itens = Decimal("0")
+        desconto_total = None
+        caminho = []
+
+        for evento, elem in ET.iterparse(self.xml_path, events=("start", "end")):
+            tag = self._tag(elem)
+            if evento == "start":
+                caminho.append(tag)
+                continue
+            caminho.pop()
+            pai = caminho[-1] if caminho else ""
+
+            if tag == "xNome" and pai == "emit":
+                self.data["loja"] = (elem.text or "").strip()
+
+            elif tag in ("dhEmi", "dEmi") and pai == "ide" and elem.text:
+                # "2024-01-05T10:22:11-03:00" ou "2024-01-05"
+                ano, mes, dia = elem.text.strip()[:10].split("-")
+                self.data["data"] = f"{dia}/{mes}/{ano}"
+
+            elif tag == "CPF" and pai == "dest" and elem.text:
+                self.data["cpf_consumidor"] = self._formata_cpf(elem.text.strip())
+
+            elif tag == "tPag" and elem.text and self.data["forma_pagamento"] == "Indefinido":
+                self.data["forma_pagamento"] = self.FORMAS_PAGAMENTO.get(elem.text.strip(), "Indefinido")
+
+            elif tag == "prod" and pai == "det":
+                prod = self._filhos(elem)
+                if prod.get("vDesc"):
+                    desconto_itens += Decimal(prod["vDesc"])
+                self.data["itens"].append({
+                    "item": prod.get("xProd", ""),
+                    "qtd": float(Decimal(prod.get("qCom") or "1")),
+                    "un": prod.get("uCom", "UN").upper(),
+                    "vl_unit": float(Decimal(prod.get("vUnCom") or "0")),
+                    "valor": float(Decimal(prod.get("vProd") or "0")),
+                })
+
+            elif tag == "vDesc" and pai == "ICMSTot" and elem.text:
+                desconto_total = Decimal(elem.text.strip())
+
+            if tag == "det":
+                # Item já lido: libera a memória do elemento
+                elem.clear()
+
+        # --- Desconto como item negativo, igual ao parser de PDF ---
+        desconto = desconto_total if desconto_total is not None else desconto_itens
+        if desconto > 0:
             self.data["itens"].append({
                 "item": "💸 DESCONTO / ABATIMENTO",
-                "qtd": 1, "un": "UN", "vl_unit": -acumulado_desconto, 
-                "valor": -acumulado_desconto
+                "qtd": 1, "un": "UN", "vl_unit": -float(desconto),
+                "valor": -float(desconto)
             })
 
-        self.data["total_nota"] = sum(item["valor"] for item in self.data["itens"])
-        return self.data
\ No newline at end of file
+        total = sum(Decimal(str(item["valor"])) for item in self.data["itens"])
+        self.data["total_nota"] = float(total)
+        return self.data
+
+
+def parse_invoice(path, nome=None, workers=1):
+    """
+    Escolhe o leitor pelo tipo do arquivo: XML da SEFAZ (rápido, exato) ou PDF.
+    path pode ser um arquivo em memória (BytesIO); aí o tipo vem de nome.
+    workers: processos para extrair as páginas do PDF (ver resolve_workers).
+    """
+    if (nome or path).lower().endswith(".xml"):
+        return XmlInvoiceParser(path).parse()
+    return InvoiceParser(path, workers).parse()
@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from logging.handlers import RotatingFileHandler
+
+# Instrumentação leve de desempenho.
+# Cada rerun do Streamlit roda numa thread própria, então guardamos os spans
+# num threading.local: uma sessão não mistura medições com outra.
+
+LOG_DIR = "logs"
+LOG_FILE = os.path.join(LOG_DIR, "perf.log")
+
+# Limites (ms) das faixas do histograma de latência por instrução SQL
+FAIXAS_MS = (1, 5, 10, 50, 100, 500, 1000)
+
+_local = threading.local()
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def _get_logger():
+    """Logger com rotação (5 arquivos de 1 MB) gravando um JSON por linha."""
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            if not os.path.exists(LOG_DIR):
+                os.makedirs(LOG_DIR)
+            logger = logging.getLogger("divcount.perf")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            handler = RotatingFileHandler(LOG_FILE, maxBytes=1_000_000, backupCount=5, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            _logger = logger
+    return _logger
+
+
+def _state():
+    if not hasattr(_local, "spans"):
+        _local.rerun_id = None
+        _local.spans = []
+        _local.depth = 0
+        _local.queries = 0
+    return _local
+
+
+def start_rerun():
+    """Zera as medições. Chamar no início de cada execução do script."""
+    estado = _state()
+    estado.rerun_id = f"{time.time():.3f}-{threading.get_ident()}"
+    estado.spans = []
+    estado.depth = 0
+    estado.queries = 0
+
+
+def count_query(n=1):
+    """Incrementa o contador de queries do rerun atual."""
+    _state().queries += n
+
+
+def get_spans():
+    """Spans do rerun atual, na ordem em que terminaram."""
+    return list(_state().spans)
+
+
+def get_query_count():
+    return _state().queries
+
+
+@contextmanager
+def span(nome):
+    """
+    Mede o tempo (e quantas queries rodaram) dentro do bloco.
+    O registro é feito mesmo se o bloco levantar exceção
+    (ex: st.rerun() e st.stop() funcionam via exceção).
+    """
+    estado = _state()
+    profundidade = estado.depth
+    estado.depth += 1
+    queries_inicio = estado.queries
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracao_ms = (time.perf_counter() - inicio) * 1000
+        estado.depth = profundidade
+        registro = {
+            "rerun": estado.rerun_id,
+            "span": nome,
+            "ms": round(duracao_ms, 3),
+            "queries": estado.queries - queries_inicio,
+            "nivel": profundidade,
+            "ts": time.time(),
+        }
+        estado.spans.append(registro)
+        try:
+            _get_logger().info(json.dumps(registro))
+        except OSError:
+            # Sem permissão de escrita (ex: deploy read-only): segue só em memória
+            pass
+
+
+def timed(nome):
+    """Decorator que envolve a função inteira num span."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(nome):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def load_log(path=LOG_FILE):
+    """Lê o log atual e os arquivos rotacionados (perf.log.1, .2, ...)."""
+    registros = []
+    arquivos = [path] + [f"{path}.{i}" for i in range(1, 6)]
+    for arquivo in arquivos:
+        if not os.path.exists(arquivo):
+            continue
+        with open(arquivo, encoding="utf-8") as f:
+            for linha in f:
+                try:
+                    registros.append(json.loads(linha))
+                except ValueError:
+                    continue
+    return registros
+
+
+def summarize(registros):
+    """
+    Agrega os registros por span: chamadas, p50, p95 e máximo (ms)
+    e média de queries por chamada.
+    """
+    por_span = {}
+    for r in registros:
+        por_span.setdefault(r["span"], []).append(r)
+
+    resumo = []
+    for nome, itens in por_span.items():
+        tempos = sorted(r["ms"] for r in itens)
+        n = len(tempos)
+        resumo.append({
+            "span": nome,
+            "chamadas": n,
+            "p50_ms": tempos[int(0.50 * (n - 1))],
+            "p95_ms": tempos[int(0.95 * (n - 1))],
+            "max_ms": tempos[-1],
+            "queries_media": round(sum(r["queries"] for r in itens) / n, 2),
+        })
+    resumo.sort(key=lambda r: r["p95_ms"], reverse=True)
+    return resumo
+
+
+class StatementStats:
+    """
+    Chamadas e histograma de latência por instrução SQL.
+    Cada DatabaseManager (uma conexão por sessão) tem o seu.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dados = {}
+
+    def record(self, nome, ms):
+        faixa = next((i for i, limite in enumerate(FAIXAS_MS) if ms <= limite), len(FAIXAS_MS))
+        with self._lock:
+            dados = self._dados.setdefault(
+                nome, {"chamadas": 0, "total_ms": 0.0, "max_ms": 0.0, "faixas": [0] * (len(FAIXAS_MS) + 1)}
+            )
+            dados["chamadas"] += 1
+            dados["total_ms"] += ms
+            dados["max_ms"] = max(dados["max_ms"], ms)
+            dados["faixas"][faixa] += 1
+
+    def snapshot(self):
+        """Uma linha por instrução, com uma coluna por faixa do histograma, mais lentas primeiro."""
+        rotulos = [f"<={limite}ms" for limite in FAIXAS_MS] + [f">{FAIXAS_MS[-1]}ms"]
+        with self._lock:
+            linhas = [
+                {
+                    "instrucao": nome,
+                    "chamadas": d["chamadas"],
+                    "media_ms": round(d["total_ms"] / d["chamadas"], 3),
+                    "max_ms": round(d["max_ms"], 3),
+                    "total_ms": round(d["total_ms"], 3),
+                    **dict(zip(rotulos, d["faixas"])),
+                }
+                for nome, d in self._dados.items()
+            ]
+        linhas.sort(key=lambda r: r["total_ms"], reverse=True)
+        return linhas
@@ -0,0 +1,25 @@
+import re
+import unicodedata
+
+# Chave normalizada de produto para o histórico de preços.
+# O mesmo produto chega com grafias diferentes entre lojas e notas
+# ("PATINHO BOV. KG", "Patinho  Bov KG", "PATINHO BOV-KG"); a chave junta
+# essas variações: sem acento, maiúsculas, só letras/números e espaços simples.
+
+_CODIGO_INICIAL = re.compile(r"^\d+\s+")
+_NAO_ALFANUM = re.compile(r"[^A-Z0-9]+")
+
+
+def text_key(texto):
+    # Sem acento, maiúsculas, só letras/números: comparação igual no Python e no SQL
+    texto = unicodedata.normalize("NFKD", str(texto or "")).encode("ascii", "ignore").decode()
+    return _NAO_ALFANUM.sub(" ", texto.upper()).strip()
+
+
+def product_key(nome):
+    # Código interno da loja no começo do nome (ex: "6675 PATINHO")
+    return _CODIGO_INICIAL.sub("", text_key(nome))
+
+
+def normalize_unit(un):
+    return (un or "UN").strip().upper()
@@ -0,0 +1,121 @@
+import re
+import unicodedata
+
+# Busca textual nos itens (nome do item e loja da nota).
+# Postgres: índices GIN sobre to_tsvector('portuguese', f_unaccent(...)).
+#   O unaccent do contrib não é IMMUTABLE, então não pode ir num índice;
+#   f_unaccent é o wrapper imutável (ou identidade, se a extensão não puder
+#   ser instalada no servidor).
+# SQLite: tabela FTS5 itens_busca (rowid = itens.id) mantida por triggers.
+# Os termos viram prefixos ("patin" acha "PATINHO"), todos obrigatórios.
+
+POR_PAGINA = 20
+
+POSTGRES_UNACCENT = """
+    CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+    AS $$ SELECT public.unaccent('public.unaccent', $1) $$;
+"""
+
+POSTGRES_SEM_UNACCENT = """
+    CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+    AS $$ SELECT $1 $$;
+"""
+
+# (nome, DDL): criados só se o índice ainda não existe
+POSTGRES_INDICES = [
+    ("idx_itens_busca", "CREATE INDEX idx_itens_busca ON itens USING GIN (to_tsvector('portuguese', f_unaccent(item_nome)));"),
+    ("idx_notas_busca", "CREATE INDEX idx_notas_busca ON notas USING GIN (to_tsvector('portuguese', f_unaccent(loja)));"),
+]
+
+SQLITE_TABELA = """
+    CREATE VIRTUAL TABLE itens_busca USING fts5(
+        item_nome, loja, tokenize = 'unicode61 remove_diacritics 2'
+    );
+"""
+
+SQLITE_CARGA = """
+    INSERT INTO itens_busca (rowid, item_nome, loja)
+    SELECT i.id, i.item_nome, n.loja FROM itens i JOIN notas n ON n.id = i.nota_id;
+"""
+
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS itens_busca_ai AFTER INSERT ON itens BEGIN
+        INSERT INTO itens_busca (rowid, item_nome, loja)
+        SELECT new.id, new.item_nome, loja FROM notas WHERE id = new.nota_id;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS itens_busca_ad AFTER DELETE ON itens BEGIN
+        DELETE FROM itens_busca WHERE rowid = old.id;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS itens_busca_au AFTER UPDATE OF item_nome ON itens BEGIN
+        UPDATE itens_busca SET item_nome = new.item_nome WHERE rowid = new.id;
+    END;
+    """,
+]
+
+# Colunas de contexto devolvidas com cada acerto
+_CONTEXTO = """
+    SELECT i.id AS item_id, i.item_nome, i.valor, i.categoria,
+           n.id AS nota_id, n.data_compra, n.loja, n.pagador,
+           hits.rank, COUNT(*) OVER () AS total
+"""
+
+
+def termos(texto):
+    texto = unicodedata.normalize("NFKD", texto or "").encode("ascii", "ignore").decode()
+    return re.findall(r"\w+", texto.lower())
+
+
+def search_sql(backend_name, texto, household_id, pagina=0, por_pagina=POR_PAGINA):
+    """
+    Monta a busca paginada, ordenada por relevância (e data, no empate).
+    Acerto no nome do item pesa mais que acerto no nome da loja.
+    Retorna (sql, params) no estilo %s, ou None se não há termos.
+    """
+    palavras = termos(texto)
+    if not palavras:
+        return None
+
+    if backend_name == "postgres":
+        consulta = " & ".join(f"{p}:*" for p in palavras)
+        # Um SELECT por índice GIN (itens e notas), unidos e agregados por item
+        hits = """
+            SELECT item_id, MAX(rank) AS rank FROM (
+                SELECT i.id AS item_id,
+                       ts_rank(to_tsvector('portuguese', f_unaccent(i.item_nome)), q) AS rank
+                FROM itens i, to_tsquery('portuguese', %s) q
+                WHERE to_tsvector('portuguese', f_unaccent(i.item_nome)) @@ q
+                UNION ALL
+                SELECT i.id, 0.5 * ts_rank(to_tsvector('portuguese', f_unaccent(n.loja)), q)
+                FROM notas n JOIN itens i ON i.nota_id = n.id, to_tsquery('portuguese', %s) q
+                WHERE to_tsvector('portuguese', f_unaccent(n.loja)) @@ q
+                  AND n.household_id = %s
+            ) t GROUP BY item_id
+        """
+        params = [consulta, consulta, household_id]
+    else:
+        consulta = " ".join(f'"{p}"*' for p in palavras)
+        # bm25 do FTS5: menor é melhor, então invertemos o sinal
+        hits = """
+            SELECT rowid AS item_id, -bm25(itens_busca, 1.0, 0.5) AS rank
+            FROM itens_busca WHERE itens_busca MATCH %s
+        """
+        params = [consulta]
+
+    sql = f"""
+        {_CONTEXTO}
+        FROM ({hits}) hits
+        JOIN itens i ON i.id = hits.item_id
+        JOIN notas n ON n.id = i.nota_id
+        WHERE n.household_id = %s
+        ORDER BY hits.rank DESC, n.data_compra DESC, i.id
+        LIMIT %s OFFSET %s
+    """
+    params += [household_id, por_pagina, pagina * por_pagina]
+    return sql, params
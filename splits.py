@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from products import text_key
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+# numpy/pandas são importados dentro das funções vetorizadas: o DatabaseManager
+# usa este módulo só para montar SQL e não deve carregar o pandas na partida.
+
+# Os participantes vêm do banco (tabela participants), na ordem do id.
+# A ordem importa: o último participante absorve a sobra de centavos.
+
+# Campo da regra -> (coluna no DataFrame, expressão SQL, tipo de comparação)
+# "contem" compara chaves normalizadas (products.text_key): o UPPER do SQLite
+# só conhece ASCII, então "CAFÉ" não acharia "Café" com UPPER(itens.item_nome).
+# As colunas SQL guardam a chave pronta; no DataFrame ela é calculada na hora.
+CAMPOS = {
+    "categoria": ("categoria", "itens.categoria", "igual"),
+    "pagador": ("pagador", "notas.pagador", "igual"),
+    "loja": ("loja", "notas.loja_key", "contem"),
+    "item": ("item_nome", "itens.item_key", "contem"),
+}
+
+
+@dataclass
+class SplitRule:
+    """
+    Regra de divisão: itens que batem com (campo, padrao) são divididos
+    proporcionalmente aos pesos ({nome: peso}; sem pesos, divide igual).
+    Regras com prioridade maior vencem.
+    - categoria/pagador: valor exato
+    - loja/item: trecho do nome (sem diferenciar maiúsculas nem acentos)
+    """
+    campo: str
+    padrao: str
+    pesos: Dict[str, float] = field(default_factory=dict)
+    prioridade: int = 0
+    id: Optional[int] = None
+
+    def fracoes(self, participantes: List[str]) -> List[float]:
+        total = sum(float(self.pesos.get(p, 0.0)) for p in participantes)
+        if total <= 0:
+            return [1.0 / len(participantes)] * len(participantes)
+        return [float(self.pesos.get(p, 0.0)) / total for p in participantes]
+
+    def mask(self, df: pd.DataFrame) -> np.ndarray:
+        coluna, _, comparacao = CAMPOS[self.campo]
+        valores = df[coluna].fillna("").astype(str)
+        if comparacao == "igual":
+            return (valores == self.padrao).to_numpy()
+        return valores.map(text_key).str.contains(text_key(self.padrao), regex=False).to_numpy()
+
+    def sql_predicate(self) -> Tuple[str, list]:
+        _, expressao, comparacao = CAMPOS[self.campo]
+        if comparacao == "igual":
+            return f"{expressao} = %s", [self.padrao]
+        # A chave só tem letras, números e espaços: nada a escapar no LIKE
+        return f"{expressao} LIKE %s", [f"%{text_key(self.padrao)}%"]
+
+    def to_row(self):
+        return (self.campo, self.padrao, json.dumps(self.pesos), self.prioridade)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            id=row["id"],
+            campo=row["campo"],
+            padrao=row["padrao"],
+            pesos=json.loads(row["pesos"]),
+            prioridade=row["prioridade"],
+        )
+
+
+def ordenar(regras: List[SplitRule]) -> List[SplitRule]:
+    # Prioridade maior primeiro; empate: a regra mais antiga vence
+    return sorted(regras, key=lambda r: (-r.prioridade, r.id if r.id is not None else float("inf")))
+
+
+def _arredonda(x):
+    import numpy as np
+
+    # Meio centavo arredonda para longe do zero, igual ao ROUND do Postgres/SQLite
+    return np.sign(x) * np.floor(np.abs(x) + 0.5)
+
+
+def apply_rules(df: pd.DataFrame, regras: List[SplitRule], participantes: List[str]) -> pd.DataFrame:
+    """
+    Divide a coluna 'valor' de df entre os participantes, de forma vetorizada.
+    df precisa das colunas usadas pelas regras (categoria, pagador, loja, item_nome).
+    Sem regra aplicável, a divisão é igual entre todos.
+    Retorna um DataFrame (mesmo índice) com uma coluna em R$ por participante;
+    a soma das partes é exatamente o valor do item, em centavos.
+    """
+    import numpy as np
+    import pandas as pd
+
+    n = len(df)
+    fracoes = np.full((n, len(participantes)), 1.0 / len(participantes))
+    definido = np.zeros(n, dtype=bool)
+
+    for regra in ordenar(regras):
+        alvo = regra.mask(df) & ~definido
+        if alvo.any():
+            fracoes[alvo] = regra.fracoes(participantes)
+            definido |= alvo
+
+    centavos = _arredonda(df["valor"].fillna(0.0).astype(float).to_numpy() * 100)
+    partes = _arredonda(centavos[:, None] * fracoes[:, :-1])
+    ultima = centavos - partes.sum(axis=1)
+    partes = np.column_stack([partes, ultima]) / 100
+
+    return pd.DataFrame(partes, index=df.index, columns=participantes)
+
+
+def _fracao_sql(regras: List[SplitRule], idx: int, participantes):
+    # CASE com a fração do participante idx em cada regra, na ordem de prioridade
+    casos, params = [], []
+    for regra in regras:
+        predicado, predicado_params = regra.sql_predicate()
+        casos.append(f"WHEN {predicado} THEN %s")
+        params += predicado_params + [regra.fracoes(participantes)[idx]]
+    params.append(1.0 / len(participantes))
+    if not casos:
+        return "%s", params
+    return f"CASE {' '.join(casos)} ELSE %s END", params
+
+
+def resplit_sql(
+    regras: List[SplitRule],
+    participantes: List[Tuple[int, str]],
+    household_id: int,
+    afetadas: Optional[List[SplitRule]] = None,
+):
+    """
+    Monta um único INSERT ... ON CONFLICT que recalcula, em item_shares, as
+    partes dos itens já salvos da casa com as regras atuais (mesma aritmética
+    de apply_rules). participantes: [(id, nome)] na ordem de divisão.
+    Se 'afetadas' for dada, só os itens que batem com alguma dessas regras
+    são reescritos.
+    Retorna (sql, params) no estilo %s, ou None se não há linhas afetadas.
+    """
+    if not participantes or (afetadas is not None and not afetadas):
+        return None
+
+    regras = ordenar(regras)
+    nomes = [nome for _, nome in participantes]
+    centavos = "ROUND(CAST(itens.valor AS NUMERIC) * 100)"
+
+    partes = []
+    for idx in range(len(nomes) - 1):
+        fracao, fracao_params = _fracao_sql(regras, idx, nomes)
+        partes.append((f"ROUND({centavos} * CAST({fracao} AS NUMERIC))", fracao_params))
+
+    # Uma linha por (item, participante): o CASE escolhe a parte de cada um
+    casos, params = [], []
+    for (parte, parte_params), (participant_id, _) in zip(partes, participantes):
+        casos.append(f"WHEN %s THEN {parte}")
+        params += [participant_id] + parte_params
+
+    # O último fica com o que sobrou, para a soma bater no centavo
+    ultima = centavos
+    if partes:
+        ultima = f"{centavos} - ({' + '.join(parte for parte, _ in partes)})"
+        for _, parte_params in partes:
+            params += parte_params
+    amount = f"(CASE p.id {' '.join(casos)} ELSE {ultima} END) / 100.0" if casos else f"{ultima} / 100.0"
+
+    where = "notas.household_id = %s"
+    params.append(household_id)
+    if afetadas is not None:
+        predicados = [r.sql_predicate() for r in afetadas]
+        where += " AND (" + " OR ".join(sql for sql, _ in predicados) + ")"
+        for _, predicado_params in predicados:
+            params += predicado_params
+
+    sql = f"""
+        INSERT INTO item_shares (item_id, participant_id, amount)
+        SELECT itens.id, p.id, {amount}
+        FROM itens
+        JOIN notas ON notas.id = itens.nota_id
+        JOIN participants p ON p.household_id = notas.household_id
+        WHERE {where}
+        ON CONFLICT (item_id, participant_id) DO UPDATE SET amount = EXCLUDED.amount
+    """
+    return sql, params
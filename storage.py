@@ -0,0 +1,229 @@
+import os
+import re
+import sqlite3
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import date, datetime
+
+import psycopg2
+import psycopg2.extras
+
+import perf
+
+# Backends de armazenamento usados pelo DatabaseManager.
+# Todo SQL do DatabaseManager é escrito no estilo do Postgres (placeholders %s);
+# cada backend sabe conectar, criar cursores e adaptar o SQL para o seu dialeto.
+#
+# Seleção via secrets.toml (ou variável de ambiente de mesmo nome):
+#   DB_BACKEND = "postgres"   -> usa DATABASE_URL (padrão, nuvem)
+#   DB_BACKEND = "sqlite"     -> usa SQLITE_PATH (padrão: divcount.db, local)
+#   STATEMENT_TIMEOUT_MS      -> tempo máximo de cada instrução (padrão 15000, 0 desliga)
+#
+# Consultas quentes passam por prepare(): no Postgres viram PREPARE/EXECUTE
+# (uma vez por conexão); o sqlite3 já guarda as instruções compiladas
+# no cache da própria conexão.
+
+STATEMENT_TIMEOUT_MS = 15000
+
+
+class _CountingCursor(psycopg2.extensions.cursor):
+    # Conta cada execute no contador de queries do rerun (painel de diagnóstico)
+    def execute(self, query, vars=None):
+        perf.count_query()
+        return super().execute(query, vars)
+
+
+class _CountingDictCursor(psycopg2.extras.RealDictCursor):
+    def execute(self, query, vars=None):
+        perf.count_query()
+        return super().execute(query, vars)
+
+
+class _CountingSqliteCursor(sqlite3.Cursor):
+    def execute(self, query, params=()):
+        perf.count_query()
+        return super().execute(query, params)
+
+    def executemany(self, query, seq):
+        perf.count_query()
+        return super().executemany(query, seq)
+
+
+class _PreparedConnection(psycopg2.extensions.connection):
+    # Nomes das instruções já preparadas nesta conexão (PREPARE vale por sessão)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+
+
+class _TimedSqliteConnection(sqlite3.Connection):
+    # Prazo da instrução atual (time.monotonic); None = sem limite
+    prazo = None
+
+    def _passou_do_prazo(self):
+        # Retornar verdadeiro interrompe a instrução (OperationalError: interrupted)
+        return self.prazo is not None and time.monotonic() > self.prazo
+
+
+def _dict_row(cursor, row):
+    return {col[0]: row[idx] for idx, col in enumerate(cursor.description)}
+
+
+# O adaptador padrão de date/datetime do sqlite3 está depreciado: registramos
+# o mesmo formato ISO que o Postgres grava nas colunas TEXT.
+sqlite3.register_adapter(date, lambda d: d.isoformat())
+sqlite3.register_adapter(datetime, lambda d: d.isoformat(sep=" "))
+
+
+class PostgresBackend:
+    name = "postgres"
+    pk_column = "SERIAL PRIMARY KEY"
+    blob_column = "BYTEA"
+
+    def __init__(self, db_url, statement_timeout_ms=STATEMENT_TIMEOUT_MS):
+        self.db_url = db_url
+        self.statement_timeout_ms = int(statement_timeout_ms)
+
+    def connect(self):
+        # O timeout fica no servidor: a instrução é cancelada lá (QueryCanceledError)
+        conn = psycopg2.connect(
+            self.db_url,
+            connection_factory=_PreparedConnection,
+            options=f"-c statement_timeout={self.statement_timeout_ms}",
+        )
+        conn.autocommit = False # Controle manual de transação igual fazíamos antes
+        return conn
+
+    def cursor(self, conn, dict_rows=False):
+        # RealDictCursor faz o Postgres devolver dicionários igual o pandas gosta
+        if dict_rows:
+            return conn.cursor(cursor_factory=_CountingDictCursor)
+        return conn.cursor(cursor_factory=_CountingCursor)
+
+    def sql(self, query):
+        return query
+
+    def prepare(self, cur, nome, query):
+        """Prepara a query no servidor (se ainda não foi) e devolve o EXECUTE equivalente."""
+        n_params = query.count("%s")
+        if nome not in cur.connection.preparadas:
+            contador = iter(range(1, n_params + 1))
+            cur.execute(f"PREPARE {nome} AS " + re.sub(r"%s", lambda _: f"${next(contador)}", query))
+            cur.connection.preparadas.add(nome)
+        if not n_params:
+            return f"EXECUTE {nome}"
+        return f"EXECUTE {nome} ({', '.join(['%s'] * n_params)})"
+
+    def deadline(self, conn):
+        return nullcontext()
+
+    # Erros de conexão perdida; QueryCanceledError (timeout) também é
+    # OperationalError, por isso quem trata confere is_closed() antes
+    connection_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+    def in_transaction(self, conn):
+        return not conn.closed and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def is_closed(self, conn):
+        # O psycopg2 marca closed quando percebe que o servidor derrubou a conexão
+        return bool(conn.closed)
+
+    def is_alive(self, conn):
+        # Transação abortada (ex: instrução cancelada pelo timeout) ou conexão perdida
+        return not conn.closed and conn.info.transaction_status not in (
+            psycopg2.extensions.TRANSACTION_STATUS_INERROR,
+            psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN,
+        )
+
+    def insert_many(self, cur, query, rows):
+        # query no formato "INSERT ... VALUES %s": um único round-trip para o lote
+        psycopg2.extras.execute_values(cur, query, rows)
+
+
+class SQLiteBackend:
+    name = "sqlite"
+    pk_column = "INTEGER PRIMARY KEY AUTOINCREMENT"
+    blob_column = "BLOB"
+
+    def __init__(self, path, statement_timeout_ms=STATEMENT_TIMEOUT_MS):
+        self.path = path
+        self.statement_timeout_ms = int(statement_timeout_ms)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, factory=_TimedSqliteConnection)
+        conn.execute("PRAGMA foreign_keys = ON")   # Necessário para o ON DELETE CASCADE
+        conn.execute("PRAGMA journal_mode = WAL")  # Leituras não bloqueiam a escrita
+        conn.execute("PRAGMA synchronous = NORMAL")
+        # O SQLite não tem statement_timeout: o handler roda a cada N instruções
+        # da VM e interrompe a consulta quando o prazo de deadline() passa
+        conn.set_progress_handler(conn._passou_do_prazo, 10000)
+        return conn
+
+    def cursor(self, conn, dict_rows=False):
+        cur = conn.cursor(_CountingSqliteCursor)
+        if dict_rows:
+            cur.row_factory = _dict_row
+        return cur
+
+    def sql(self, query):
+        return query.replace("%s", "?")
+
+    def prepare(self, cur, nome, query):
+        return self.sql(query)
+
+    @contextmanager
+    def deadline(self, conn):
+        if not self.statement_timeout_ms:
+            yield
+            return
+        conn.prazo = time.monotonic() + self.statement_timeout_ms / 1000
+        try:
+            yield
+        finally:
+            conn.prazo = None
+
+    connection_errors = (sqlite3.ProgrammingError,)  # conexão fechada
+
+    def in_transaction(self, conn):
+        return not self.is_closed(conn) and conn.in_transaction
+
+    def is_closed(self, conn):
+        try:
+            conn.total_changes
+        except sqlite3.ProgrammingError:
+            return True
+        return False
+
+    def is_alive(self, conn):
+        # O sqlite3 não deixa a transação abortada: erro na instrução não afeta a conexão
+        return not self.is_closed(conn)
+
+    def insert_many(self, cur, query, rows):
+        if not rows:
+            return
+        placeholders = "(" + ",".join("?" * len(rows[0])) + ")"
+        cur.executemany(query.replace("%s", placeholders), rows)
+
+
+def config_value(key, default=None):
+    # Lê do secrets.toml; sem secrets (testes, uso offline) cai para o ambiente
+    import streamlit as st
+    try:
+        if key in st.secrets:
+            return st.secrets[key]
+    except Exception:
+        pass
+    return os.environ.get(key, default)
+
+
+def backend_from_config():
+    backend = str(config_value("DB_BACKEND", "postgres")).lower()
+    timeout_ms = config_value("STATEMENT_TIMEOUT_MS", STATEMENT_TIMEOUT_MS)
+    if backend == "sqlite":
+        return SQLiteBackend(config_value("SQLITE_PATH", "divcount.db"), timeout_ms)
+    if backend == "postgres":
+        db_url = config_value("DATABASE_URL")
+        if not db_url:
+            raise KeyError("DATABASE_URL não configurada nos secrets")
+        return PostgresBackend(db_url, timeout_ms)
+    raise ValueError(f"DB_BACKEND desconhecido: {backend}")
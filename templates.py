@@ -0,0 +1,143 @@
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import Optional, Pattern, Tuple
+
+# Modelos de layout de nota por loja.
+# A primeira página vira uma impressão digital (CNPJ do emitente + texto do
+# cabeçalho). Se ela bate com um modelo conhecido, os itens saem das regexes
+# fixas do modelo, sem as heurísticas do InvoiceParser genérico. Se o resultado
+# não fechar com o total impresso na nota, o InvoiceParser volta para o leitor
+# genérico.
+#
+# Por enquanto só o layout padrão do DANFE NFC-e está cadastrado. Para uma
+# loja com layout próprio: CNPJs (só dígitos) das filiais e a regex da linha
+# de item, via register().
+
+LINHAS_CABECALHO = 8  # linhas do topo da 1ª página usadas na impressão digital
+
+_RE_CNPJ = re.compile(r"CNPJ\D{0,5}(\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2})", re.IGNORECASE)
+_RE_NAO_DIGITO = re.compile(r"\D")
+_RE_ESPACOS = re.compile(r"\s+")
+_RE_CODIGO = re.compile(r"^\d+\s+")
+
+# Linhas de sistema que aparecem no meio da tabela (quebra de página etc.)
+_RE_SISTEMA = re.compile(r"P[ÁA]GINA|PAGE|DANFE|CONSUMIDOR|NFC-E|VERS[ÃA]O", re.IGNORECASE)
+
+_RE_TOTAL = re.compile(r"VALOR\s+TOTAL\s+R\$\s*(\d{1,3}(?:\.\d{3})*,\d{2})", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class Fingerprint:
+    cnpj: str       # só dígitos ("" se não achou)
+    cabecalho: str  # topo da página sem acento, maiúsculo, espaços simples
+    loja: str       # primeira linha (razão social do emitente)
+
+
+def _normaliza(texto):
+    texto = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode()
+    return _RE_ESPACOS.sub(" ", texto.upper()).strip()
+
+
+def fingerprint(texto_primeira_pagina):
+    linhas = [l.strip() for l in texto_primeira_pagina.split("\n") if l.strip()]
+    topo = linhas[:LINHAS_CABECALHO]
+    cnpj = next((m.group(1) for m in map(_RE_CNPJ.search, topo) if m), "")
+    return Fingerprint(
+        cnpj=_RE_NAO_DIGITO.sub("", cnpj),
+        cabecalho=_normaliza(" ".join(topo)),
+        loja=topo[0] if topo else "",
+    )
+
+
+@dataclass
+class StoreTemplate:
+    """
+    Layout conhecido de nota.
+    - item: regex de uma linha de item, com os grupos nome, qtd, un, vl_unit e valor
+    - inicio/fim: linhas que abrem e fecham a tabela (None: a área toda é tabela)
+    - cnpjs: filiais com esse layout; sem CNPJ, o modelo vale para qualquer
+      cabeçalho que contenha todos os marcadores
+    - loja: nome fixo; sem ele, a razão social da primeira linha
+    """
+    nome: str
+    item: Pattern
+    inicio: Optional[Pattern] = None
+    fim: Optional[Pattern] = None
+    cnpjs: Tuple[str, ...] = ()
+    marcadores: Tuple[str, ...] = ()
+    loja: Optional[str] = None
+
+    def matches(self, impressao):
+        if self.cnpjs:
+            return impressao.cnpj in self.cnpjs
+        return bool(self.marcadores) and all(m in impressao.cabecalho for m in self.marcadores)
+
+    def read_items(self, linhas):
+        """Linhas da tabela -> lista de (nome, qtd, un, vl_unit, valor) ainda como texto."""
+        itens = []
+        lendo = self.inicio is None
+        pendente = ""
+        for linha in linhas:
+            linha = linha.strip()
+            if not linha:
+                continue
+            if not lendo:
+                lendo = bool(self.inicio.search(linha))
+                continue
+            if self.fim is not None and self.fim.search(linha):
+                break
+
+            match = self.item.search(linha)
+            if match:
+                nome = _RE_CODIGO.sub("", match.group("nome").strip())
+                if pendente:
+                    # Descrição longa quebrada: o começo veio na linha anterior
+                    nome = f"{pendente} {nome}".strip()
+                    pendente = ""
+                itens.append((nome, match.group("qtd"), match.group("un").upper(),
+                              match.group("vl_unit"), match.group("valor")))
+            elif not _RE_SISTEMA.search(linha):
+                pendente = _RE_CODIGO.sub("", linha)
+        return itens
+
+
+def printed_total(linhas):
+    """Valor total impresso na nota (texto), ou None."""
+    for linha in linhas:
+        match = _RE_TOTAL.search(linha)
+        if match:
+            return match.group(1)
+    return None
+
+
+# Layout padrão do DANFE NFC-e (Código | Descrição | Qtde | UN | Vl Unit | Vl Total),
+# usado pela maioria das redes. Lojas com layout próprio entram antes dele.
+DANFE_NFCE = StoreTemplate(
+    nome="danfe_nfce",
+    item=re.compile(
+        r"^(?P<nome>.+?)\s+(?P<qtd>\d+(?:,\d+)?)\s*(?P<un>[A-Za-z]{1,3})\s+"
+        r"(?P<vl_unit>\d+(?:\.\d{3})*(?:,\d+)?)\s+(?P<valor>\d+(?:\.\d{3})*,\d{2})$"
+    ),
+    inicio=re.compile(r"C[ÓO]DIGO\s+DESCRI[ÇC][ÃA]O\s+QTDE?\.?\s+UN", re.IGNORECASE),
+    fim=re.compile(r"QTD\.?\s+TOTAL\s+DE\s+ITENS|VALOR\s+TOTAL", re.IGNORECASE),
+    marcadores=("DANFE NFC-E", "CODIGO DESCRICAO QTDE UN VL UNIT VL TOTAL"),
+)
+
+TEMPLATES = [DANFE_NFCE]
+
+
+def register(template):
+    """Cadastra um layout de loja; modelos com CNPJ têm prioridade sobre os genéricos."""
+    TEMPLATES.insert(0, template)
+
+
+def match(texto_primeira_pagina):
+    """Modelo da nota (pela impressão digital da primeira página), ou None."""
+    impressao = fingerprint(texto_primeira_pagina)
+    por_cnpj = [t for t in TEMPLATES if t.cnpjs]
+    genericos = [t for t in TEMPLATES if not t.cnpjs]
+    for template in por_cnpj + genericos:
+        if template.matches(impressao):
+            return template, impressao
+    return None, impressao
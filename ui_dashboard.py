@@ -3,6 +3,10 @@ import pandas as pd
 import altair as alt
 from datetime import datetime
 
+import cache
+import charts
+import perf
+
 # --- FUNÇÕES AUXILIARES ---
 
 def make_donut_chart(df, coluna_valor, coluna_label, tipo='azul'):
@@ -33,103 +37,98 @@ def make_donut_chart(df, coluna_valor, coluna_label, tipo='azul'):
 
 # --- FUNÇÃO DASHBOARD RENDER ---
 
+@perf.timed("ui.render_dashboard")
 def render_dashboard(manager):
-    df_compras, df_reembolsos = manager.get_financial_data()
-    
+    df_compras, _ = cache.financial_data(manager, manager.household_id)
+
     if df_compras.empty:
         st.info("📭 Nenhuma compra registrada. Comece processando uma nota na aba 'Processar Nota'.")
         return
 
-    # --- INÍCIO: CÁLCULOS GLOBAIS (BALANÇO) ---
-    # Conversão de data para uso em filtros e gráficos (IMPORTANTE)
-    df_compras['data_compra'] = pd.to_datetime(df_compras['data_compra'], format='%d/%m/%Y', errors='coerce')
+    # Cada bloco é um fragmento: interagir com ele reexecuta só o próprio bloco,
+    # lendo os dados do cache em vez do banco
+    _render_balanco(manager)
+    _render_analise(manager)
+
+
+@st.fragment
+@perf.timed("ui.dashboard.balanco")
+def _render_balanco(manager):
+    # Uma linha por participante, agregada no banco (ver get_balances)
+    saldos = cache.balances(manager, manager.household_id)
+    nomes = [b["nome"] for b in saldos]
 
-    # 1. Consumo Total
-    k_consumo_total = df_compras["kristian_parte"].sum()
-    g_consumo_total = df_compras["giulia_parte"].sum()
-    
-    # 2. Pagamento na Loja
-    k_pagou_loja_total = df_compras[df_compras["pagador"] == "Kristian"]["valor"].sum()
-    g_pagou_loja_total = df_compras[df_compras["pagador"] == "Giulia"]["valor"].sum()
-    
-    # 3. Pix (Reembolsos)
-    k_recebeu_pix = df_reembolsos[df_reembolsos["recebedor"] == "Kristian"]["valor"].sum() if not df_reembolsos.empty else 0.0
-    g_recebeu_pix = df_reembolsos[df_reembolsos["recebedor"] == "Giulia"]["valor"].sum() if not df_reembolsos.empty else 0.0
-    k_enviou_pix = df_reembolsos[df_reembolsos["pagador"] == "Kristian"]["valor"].sum() if not df_reembolsos.empty else 0.0
-    g_enviou_pix = df_reembolsos[df_reembolsos["pagador"] == "Giulia"]["valor"].sum() if not df_reembolsos.empty else 0.0
-
-    # 4. Cálculo do Saldo
-    k_total_desembolso = k_pagou_loja_total + k_enviou_pix
-    g_total_desembolso = g_pagou_loja_total + g_enviou_pix
-    saldo_k = (k_total_desembolso) - k_recebeu_pix - k_consumo_total
-    
     # -----------------------------------------------
     # BLOCO 1: BALANÇO E QUITAÇÃO (TOPO)
     # -----------------------------------------------
     st.markdown("### 🏦 Balanço Atual (Acumulado)")
     col_balanco, col_quitacao = st.columns([1, 2])
-    
+
+    devedores = sorted((b for b in saldos if b["saldo"] < -0.01), key=lambda b: b["saldo"])
+    credores = sorted((b for b in saldos if b["saldo"] > 0.01), key=lambda b: -b["saldo"])
+
     with col_balanco:
-        valor_divida = abs(saldo_k)
-        if saldo_k > 0.01: 
-            st.error(f"🚨 **Giulia deve: R$ {valor_divida:.2f}**")
-            st.caption("para o Kristian")
-        elif saldo_k < -0.01: 
-            st.error(f"🚨 **Kristian deve: R$ {valor_divida:.2f}**")
-            st.caption("para a Giulia")
-        else:
+        if not devedores:
             st.success("✅ **Contas em dia!**")
+        elif len(saldos) == 2:
+            st.error(f"🚨 **{devedores[0]['nome']} deve: R$ {abs(devedores[0]['saldo']):.2f}**")
+            st.caption(f"para {credores[0]['nome']}" if credores else "")
+        else:
+            for b in devedores:
+                st.error(f"🚨 **{b['nome']} deve: R$ {abs(b['saldo']):.2f}**")
+            for b in credores:
+                st.caption(f"{b['nome']} tem a receber R$ {b['saldo']:.2f}")
 
     with col_quitacao:
         with st.expander("💸 Registrar Quitação (Pix)"):
             c_pag, c_rec, c_val, c_btn = st.columns([1.5, 1.5, 1.5, 1])
-            idx_pag = 1 if saldo_k > 0 else 0 
-            quem_paga = c_pag.selectbox("Quem pagou?", ["Kristian", "Giulia"], index=idx_pag)
-            quem_recebe = "Kristian" if quem_paga == "Giulia" else "Giulia"
-            c_rec.text_input("Quem recebe?", value=quem_recebe, disabled=True)
+            # Sugestão: quem mais deve paga quem mais tem a receber
+            idx_pag = nomes.index(devedores[0]["nome"]) if devedores else 0
+            quem_paga = c_pag.selectbox("Quem pagou?", nomes, index=idx_pag)
+            outros = [n for n in nomes if n != quem_paga]
+            idx_rec = outros.index(credores[0]["nome"]) if credores and credores[0]["nome"] in outros else 0
+            quem_recebe = c_rec.selectbox("Quem recebe?", outros, index=idx_rec)
             valor_pgto = c_val.number_input("Valor (R$)", min_value=0.0, step=10.0)
+            comprovante = st.file_uploader("Comprovante (opcional)", type=["pdf", "png", "jpg", "jpeg"])
             if c_btn.button("Confirmar", use_container_width=True):
-                if valor_pgto > 0:
-                    if manager.save_reimbursement(quem_paga, quem_recebe, valor_pgto):
+                if valor_pgto > 0 and quem_recebe:
+                    arquivo = (comprovante.name, comprovante.getvalue()) if comprovante else None
+                    if manager.save_reimbursement(quem_paga, quem_recebe, valor_pgto, arquivo):
+                        cache.invalidate()
                         st.toast("Salvo!", icon="✅")
-                        st.rerun()
+                        # Só o balanço muda: reexecuta apenas este fragmento
+                        cache.rerun_fragment()
 
     st.markdown("---")
-    
+
     # -----------------------------------------------
     # BLOCO 2: BALANÇO DETALHADO (RESTAURADO)
     # -----------------------------------------------
     st.markdown("### 🔍 Detalhamento Financeiro (Total)")
-    
-    col_k_pagou, col_g_pagou, col_k_consumiu, col_g_consumiu = st.columns(4)
-    
-    col_k_pagou.metric(
-        "Kristian Desembolsou (Loja + Pix)", 
-        f"R$ {k_total_desembolso:.2f}",
-        delta=f"Pix Enviado: R$ {k_enviou_pix:.2f} / Recebido: R$ {k_recebeu_pix:.2f}", 
-        delta_color="off"
-    )
-    col_g_pagou.metric(
-        "Giulia Desembolsou (Loja + Pix)", 
-        f"R$ {g_total_desembolso:.2f}",
-        delta=f"Pix Enviado: R$ {g_enviou_pix:.2f} / Recebido: R$ {g_recebeu_pix:.2f}", 
-        delta_color="off"
-    )
-    col_k_consumiu.metric(
-        "Kristian Consumiu (Gasto Real)", 
-        f"R$ {k_consumo_total:.2f}",
-        delta=f"Pago na Loja: R$ {k_pagou_loja_total:.2f}",
-        delta_color="off"
-    )
-    col_g_consumiu.metric(
-        "Giulia Consumiu (Gasto Real)", 
-        f"R$ {g_consumo_total:.2f}",
-        delta=f"Pago na Loja: R$ {g_pagou_loja_total:.2f}",
-        delta_color="off"
-    )
+
+    for col, b in zip(st.columns(len(saldos)), saldos):
+        col.metric(
+            f"{b['nome']} Desembolsou (Loja + Pix)",
+            f"R$ {b['desembolso']:.2f}",
+            delta=f"Pix Enviado: R$ {b['pix_enviado']:.2f} / Recebido: R$ {b['pix_recebido']:.2f}",
+            delta_color="off"
+        )
+        col.metric(
+            f"{b['nome']} Consumiu (Gasto Real)",
+            f"R$ {b['consumo']:.2f}",
+            delta=f"Pago na Loja: R$ {b['pago_loja']:.2f}",
+            delta_color="off"
+        )
 
     st.markdown("---")
-    
+
+
+@st.fragment
+@perf.timed("ui.dashboard.analise")
+def _render_analise(manager):
+    df_compras, _ = cache.financial_data(manager, manager.household_id)
+    nomes = [b["nome"] for b in cache.balances(manager, manager.household_id)]
+
     # -----------------------------------------------
     # BLOCO 3: ANÁLISE DE COMPRAS (FILTROS E GRÁFICOS)
     # -----------------------------------------------
@@ -143,12 +142,14 @@ def render_dashboard(manager):
         min_date = df_compras['data_compra'].min().date()
         max_date = df_compras['data_compra'].max().date()
         
-        data_inicio, data_fim = f_col1.date_input(
+        periodo = f_col1.date_input(
             "Período", 
             value=(min_date, max_date), 
             min_value=min_date, 
             max_value=max_date
         )
+        # Enquanto só a data inicial foi escolhida, o widget devolve 1 data
+        data_inicio, data_fim = periodo if len(periodo) == 2 else (periodo[0], max_date)
         
         # Filtro Categoria
         categorias = ["Todas"] + sorted(df_compras['categoria'].unique().tolist())
@@ -180,7 +181,8 @@ def render_dashboard(manager):
         
         with col_g1:
             if not df_cat.empty:
-                chart = alt.Chart(df_cat).mark_bar(color='#14AAFF').encode(
+                df_barras = charts.cap_categories(df_cat, "categoria", "valor", charts.MAX_BARRAS)
+                chart = alt.Chart(df_barras).mark_bar(color='#14AAFF').encode(
                     x=alt.X('valor', title='Total (R$)'),
                     y=alt.Y('categoria', sort='-x', title=''),
                     tooltip=['categoria', alt.Tooltip('valor', format=",.2f")]
@@ -191,23 +193,44 @@ def render_dashboard(manager):
                 
         with col_g2:
             if not df_cat.empty:
-                st.altair_chart(make_donut_chart(df_cat, "valor", "categoria", tipo='azul'), use_container_width=True)
+                df_fatias = charts.cap_categories(df_cat, "categoria", "valor", charts.MAX_FATIAS)
+                st.altair_chart(make_donut_chart(df_fatias, "valor", "categoria", tipo='azul'), use_container_width=True)
+
+        # Consumo de cada participante por categoria (agregado no banco)
+        df_partes = cache.category_shares(
+            manager, manager.household_id, data_inicio, data_fim, None if loja_selecionada == "Todas" else loja_selecionada
+        )
+        if cat_selecionada != "Todas":
+            df_partes = df_partes[df_partes["categoria"] == cat_selecionada]
+        if not df_partes.empty:
+            st.markdown("##### 👥 Consumo por participante")
+            df_partes = charts.cap_categories(df_partes, "categoria", "valor", charts.MAX_BARRAS)
+            chart_partes = alt.Chart(df_partes).mark_bar().encode(
+                x=alt.X('sum(valor)', title='Total (R$)'),
+                y=alt.Y('categoria', sort='-x', title=''),
+                color=alt.Color('participante', title='', scale=alt.Scale(range=['#14AAFF', '#69E2FF', '#0077C2', '#004BA0'])),
+                tooltip=['categoria', 'participante', alt.Tooltip('valor', format=",.2f")]
+            )
+            st.altair_chart(chart_partes, use_container_width=True)
 
     # ABA 2: EVOLUÇÃO (Corrigido para usar a data da nota)
-        with tab_tempo:
-            if not df_filtered.empty:
-                # Agrupa e ORDENA por data para a linha não ficar bagunçada
-                df_tempo = df_filtered.groupby("data_compra")["valor"].sum().reset_index().sort_values("data_compra")
-                
-                # Gráfico de Linha com Eixo Temporal (:T)
-                line = alt.Chart(df_tempo).mark_line(point=True, color='#14AAFF').encode(
-                    x=alt.X('data_compra:T', title='Data da Nota', axis=alt.Axis(format="%d/%m")), # :T força entender como tempo
-                    y=alt.Y('valor', title='Valor (R$)'),
-                    tooltip=[alt.Tooltip('data_compra', format='%d/%m/%Y', title="Data"), alt.Tooltip('valor', format=",.2f")]
-                ).interactive()
-                st.altair_chart(line, use_container_width=True)
-            else:
-                st.warning("Sem dados.")
+    with tab_tempo:
+        if not df_filtered.empty:
+            # Agrupa por dia, semana ou mês conforme o período, já ordenado
+            df_tempo, (_, periodo_nome, formato_eixo, formato_tooltip) = charts.bin_time_series(
+                df_filtered, "data_compra", "valor"
+            )
+            st.caption(f"Agrupado por: {periodo_nome}")
+
+            # Gráfico de Linha com Eixo Temporal (:T)
+            line = alt.Chart(df_tempo).mark_line(point=True, color='#14AAFF').encode(
+                x=alt.X('data_compra:T', title='Data da Nota', axis=alt.Axis(format=formato_eixo)), # :T força entender como tempo
+                y=alt.Y('valor', title='Valor (R$)'),
+                tooltip=[alt.Tooltip('data_compra:T', format=formato_tooltip, title="Período"), alt.Tooltip('valor', format=",.2f")]
+            ).interactive()
+            st.altair_chart(line, use_container_width=True)
+        else:
+            st.warning("Sem dados.")
     
     # -----------------------------------------------
     # BLOCO 4: DOWNLOAD E TABELA BRUTA (RESTAURADO)
@@ -216,7 +239,7 @@ def render_dashboard(manager):
         st.markdown("### 📥 Exportar Dados")
         
         if not df_filtered.empty:
-            df_export = df_filtered[['data_compra', 'loja', 'pagador', 'item_nome', 'categoria', 'valor', 'kristian_parte', 'giulia_parte']]
+            df_export = df_filtered[['data_compra', 'loja', 'pagador', 'item_nome', 'categoria', 'valor'] + nomes]
             csv = df_export.to_csv(index=False, date_format='%d/%m/%Y').encode('utf-8')
             
             st.download_button(
@@ -229,10 +252,9 @@ def render_dashboard(manager):
         with st.expander("🔎 Ver Tabela Completa (Itens Filtrados)"):
             if not df_filtered.empty:
                 st.dataframe(
-                    df_filtered.drop(columns=['nota_id']).style.format({
+                    df_filtered.drop(columns=['nota_id', 'item_id']).style.format({
                         "valor": "R$ {:.2f}",
-                        "kristian_parte": "R$ {:.2f}",
-                        "giulia_parte": "R$ {:.2f}",
+                        **{nome: "R$ {:.2f}" for nome in nomes},
                         "data_compra": lambda t: t.strftime('%d/%m/%Y')
                     }), 
                     use_container_width=True, 
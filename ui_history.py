@@ -2,88 +2,288 @@ import streamlit as st
 import pandas as pd
 from datetime import datetime
 
+import archive
+import cache
+import perf
+import search
+from splits import CAMPOS, SplitRule
+
+@perf.timed("ui.render_history_manager")
 def render_history_manager(db_manager):
     st.markdown("### 🗂️ Histórico Completo")
 
-    tab_notas, tab_reembolsos = st.tabs(["🛒 Notas Fiscais", "💸 Reembolsos/Pix"])
+    tab_busca, tab_notas, tab_reembolsos, tab_regras, tab_arquivo = st.tabs(
+        ["🔎 Buscar Itens", "🛒 Notas Fiscais", "💸 Reembolsos/Pix", "⚖️ Regras de Divisão", "📦 Originais"]
+    )
+
+    # -------------------------------
+    # BUSCA EM TODO O HISTÓRICO
+    # -------------------------------
+    with tab_busca:
+        _render_busca(db_manager)
 
     # -------------------------------
     # ABA 1: NOTAS FISCAIS
     # -------------------------------
     with tab_notas:
-        notas = db_manager.get_all_invoices()
+        _render_notas(db_manager)
+
+    # -------------------------------
+    # ABA 2: REEMBOLSOS
+    # -------------------------------
+    with tab_reembolsos:
+        _render_reembolsos(db_manager)
+
+    # -------------------------------
+    # ABA 3: REGRAS DE DIVISÃO
+    # -------------------------------
+    with tab_regras:
+        st.caption(
+            "Itens sem regra são divididos igualmente entre os participantes. Ao criar, alterar ou excluir uma regra, "
+            "os itens já salvos que ela atinge são redivididos."
+        )
+        regras = cache.split_rules(db_manager, db_manager.household_id)
+        participantes = [p["nome"] for p in cache.participants(db_manager, db_manager.household_id)]
+
+        for regra in regras:
+            with st.container(border=True):
+                c1, c2 = st.columns([4, 1])
+                pesos = " / ".join(f"{p}: {regra.pesos.get(p, 0):g}" for p in participantes)
+                c1.markdown(f"**{regra.campo}** = `{regra.padrao}` ➝ {pesos}")
+                c1.caption(f"Prioridade: {regra.prioridade}")
+                if c2.button("🗑️ Excluir", key=f"del_regra_{regra.id}"):
+                    if db_manager.delete_split_rule(regra):
+                        cache.invalidate()
+                    st.rerun()
+
+        with st.form("form_nova_regra", clear_on_submit=True):
+            st.markdown("#### ➕ Nova regra")
+            c_campo, c_padrao, c_prio = st.columns([1, 2, 1])
+            campo = c_campo.selectbox("Campo", list(CAMPOS))
+            padrao = c_padrao.text_input("Valor / trecho do nome")
+            prioridade = c_prio.number_input("Prioridade", value=0, step=1)
+            cols_pesos = st.columns(len(participantes))
+            pesos = {
+                p: col.number_input(f"Peso {p}", min_value=0.0, value=1.0, step=0.5)
+                for p, col in zip(participantes, cols_pesos)
+            }
+            if st.form_submit_button("Salvar regra"):
+                if padrao.strip() and sum(pesos.values()) > 0:
+                    if db_manager.save_split_rule(SplitRule(campo, padrao.strip(), pesos, int(prioridade))):
+                        cache.invalidate()
+                        st.toast("Regra salva e histórico redividido!", icon="✅")
+                        st.rerun()
+                else:
+                    st.warning("Informe o valor da regra e ao menos um peso maior que zero.")
+
+    # -------------------------------
+    # ABA 4: ORIGINAIS ARQUIVADOS
+    # -------------------------------
+    with tab_arquivo:
+        _render_arquivo(db_manager)
+
+
+@st.fragment
+@perf.timed("ui.history.busca")
+def _render_busca(db_manager):
+    # A busca roda no índice do banco e traz só a página pedida
+    texto = st.text_input("Buscar item ou loja", placeholder="ex: patinho, café pilão, atacadão")
+    if st.session_state.get("busca_texto") != texto:
+        st.session_state["busca_texto"] = texto
+        st.session_state["busca_pagina"] = 0
+    pagina = st.session_state.get("busca_pagina", 0)
+
+    df_hits, total = cache.search_items(db_manager, db_manager.household_id, texto, pagina)
+    if df_hits is None:
+        st.caption("Digite parte do nome de um item ou de uma loja.")
+        return
+    if total == 0:
+        st.info("Nenhum item encontrado.")
+        return
+
+    paginas = (total - 1) // search.POR_PAGINA + 1
+    st.caption(f"{total} itens encontrados · página {pagina + 1} de {paginas}")
+    df_hits["data_compra"] = cache.parse_dates(df_hits["data_compra"])
+    st.dataframe(
+        df_hits[["data_compra", "item_nome", "valor", "categoria", "loja", "pagador"]],
+        column_config={
+            "data_compra": st.column_config.DateColumn("Data", format="DD/MM/YYYY"),
+            "item_nome": "Item",
+            "valor": st.column_config.NumberColumn("Valor", format="R$ %.2f"),
+            "categoria": "Categoria",
+            "loja": "Loja",
+            "pagador": "Pagador",
+        },
+        hide_index=True,
+        use_container_width=True,
+    )
+
+    c_ant, _, c_prox = st.columns([1, 4, 1])
+    if c_ant.button("◀ Anterior", disabled=pagina == 0, use_container_width=True):
+        st.session_state["busca_pagina"] = pagina - 1
+        cache.rerun_fragment()
+    if c_prox.button("Próxima ▶", disabled=pagina + 1 >= paginas, use_container_width=True):
+        st.session_state["busca_pagina"] = pagina + 1
+        cache.rerun_fragment()
 
-        if not notas:
-            st.info("Nenhuma nota registrada.")
+
+# As listas com botão de excluir são fragmentos: excluir reexecuta só a lista,
+# que lê do cache compartilhado em vez de recarregar a página inteira
+
+@st.fragment
+@perf.timed("ui.history.notas")
+def _render_notas(db_manager):
+    notas = cache.invoices(db_manager, db_manager.household_id)
+
+    if not notas:
+        st.info("Nenhuma nota registrada.")
+    else:
+        df_notas = pd.DataFrame(notas)
+
+        # Converte data_compra para datetime (ISO do banco ou dd/mm/YYYY antigo)
+        df_notas["data_compra_dt"] = cache.parse_dates(df_notas["data_compra"])
+
+        # Filtros
+        st.markdown("#### 🔎 Filtros")
+        col_f1, col_f2 = st.columns(2)
+
+        min_date = df_notas["data_compra_dt"].min().date()
+        max_date = df_notas["data_compra_dt"].max().date()
+
+        periodo = col_f1.date_input(
+            "Período",
+            value=(min_date, max_date),
+            min_value=min_date,
+            max_value=max_date,
+        )
+        # Enquanto só a data inicial foi escolhida, o widget devolve 1 data
+        data_inicio, data_fim = periodo if len(periodo) == 2 else (periodo[0], max_date)
+
+        lojas = ["Todas"] + sorted(df_notas["loja"].unique().tolist())
+        loja_sel = col_f2.selectbox("Loja", lojas)
+
+        # Aplica filtros
+        df_filtrado = df_notas.copy()
+        df_filtrado = df_filtrado[
+            (df_filtrado["data_compra_dt"].dt.date >= data_inicio)
+            & (df_filtrado["data_compra_dt"].dt.date <= data_fim)
+        ]
+
+        if loja_sel != "Todas":
+            df_filtrado = df_filtrado[df_filtrado["loja"] == loja_sel]
+
+        if df_filtrado.empty:
+            st.info("Nenhuma nota encontrada para os filtros selecionados.")
         else:
-            df_notas = pd.DataFrame(notas)
+            # Agrupa por data (string original) para manter visual amigável
+            for data_str in df_filtrado["data_compra"].unique():
+                notas_dia = df_filtrado[df_filtrado["data_compra"] == data_str]
+                with st.expander(f"📅 {data_str} ({len(notas_dia)} notas)"):
+                    for _, row in notas_dia.iterrows():
+                        c1, c2 = st.columns([4, 1])
+                        c1.markdown(
+                            f"**{row['loja']}** | {row['pagador']} | **R$ {row['total_nota']:.2f}**"
+                        )
+                        if c2.button("🗑️ Excluir", key=f"del_n_{row['id']}"):
+                            if db_manager.delete_invoice(row["id"]):
+                                cache.invalidate()
+                            cache.rerun_fragment()
 
-            # Converte data_compra para datetime (formato dd/mm/YYYY vindo do app)
-            df_notas["data_compra_dt"] = pd.to_datetime(
-                df_notas["data_compra"],
-                format="%d/%m/%Y",
-                errors="coerce",
-            )
 
-            # Filtros
-            st.markdown("#### 🔎 Filtros")
-            col_f1, col_f2 = st.columns(2)
+@st.fragment
+@perf.timed("ui.history.reembolsos")
+def _render_reembolsos(db_manager):
+    reembolsos = cache.reimbursements(db_manager, db_manager.household_id)
 
-            min_date = df_notas["data_compra_dt"].min().date()
-            max_date = df_notas["data_compra_dt"].max().date()
+    if not reembolsos:
+        st.info("Nenhum reembolso registrado.")
+    else:
+        for r in reembolsos:
+            with st.container(border=True):
+                c1, c2 = st.columns([4, 1])
+                c1.markdown(
+                    f"💸 **{r['pagador']}** ➝ **{r['recebedor']}**: R$ {r['valor']:.2f}"
+                )
+                c1.caption(f"Data: {r['data_pagamento']}")
+                if c2.button("🗑️ Excluir", key=f"del_r_{r['id']}"):
+                    if db_manager.delete_reimbursement(r["id"]):
+                        cache.invalidate()
+                    cache.rerun_fragment()
 
-            data_inicio, data_fim = col_f1.date_input(
-                "Período",
-                value=(min_date, max_date),
-                min_value=min_date,
-                max_value=max_date,
-            )
 
-            lojas = ["Todas"] + sorted(df_notas["loja"].unique().tolist())
-            loja_sel = col_f2.selectbox("Loja", lojas)
-
-            # Aplica filtros
-            df_filtrado = df_notas.copy()
-            df_filtrado = df_filtrado[
-                (df_filtrado["data_compra_dt"].dt.date >= data_inicio)
-                & (df_filtrado["data_compra_dt"].dt.date <= data_fim)
-            ]
-
-            if loja_sel != "Todas":
-                df_filtrado = df_filtrado[df_filtrado["loja"] == loja_sel]
-
-            if df_filtrado.empty:
-                st.info("Nenhuma nota encontrada para os filtros selecionados.")
-            else:
-                # Agrupa por data (string original) para manter visual amigável
-                for data_str in df_filtrado["data_compra"].unique():
-                    notas_dia = df_filtrado[df_filtrado["data_compra"] == data_str]
-                    with st.expander(f"📅 {data_str} ({len(notas_dia)} notas)"):
-                        for _, row in notas_dia.iterrows():
-                            c1, c2 = st.columns([4, 1])
-                            c1.markdown(
-                                f"**{row['loja']}** | {row['pagador']} | **R$ {row['total_nota']:.2f}**"
-                            )
-                            if c2.button("🗑️ Excluir", key=f"del_n_{row['id']}"):
-                                db_manager.delete_invoice(row["id"])
-                                st.rerun()
+def _carregar_original(arquivo_hash):
+    st.session_state["original_carregado"] = arquivo_hash
 
-    # -------------------------------
-    # ABA 2: REEMBOLSOS
-    # -------------------------------
-    with tab_reembolsos:
-        reembolsos = db_manager.get_all_reimbursements()
 
-        if not reembolsos:
-            st.info("Nenhum reembolso registrado.")
+@st.fragment
+@perf.timed("ui.history.arquivo")
+def _render_arquivo(db_manager):
+    documentos = cache.archived_documents(db_manager, db_manager.household_id)
+    if not documentos:
+        st.info("Nenhum original arquivado. As notas e comprovantes salvos a partir de agora ficam guardados aqui.")
+        return
+
+    df_docs = pd.DataFrame(documentos)
+    # Arquivo repetido (mesmo hash) é guardado uma vez só
+    unicos = df_docs.drop_duplicates("hash")
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Arquivos", len(unicos))
+    c2.metric("Tamanho original", f"{unicos['tamanho'].sum() / 1024:.0f} KB")
+    c3.metric("Comprimido (zstd)", f"{unicos['comprimido'].sum() / 1024:.0f} KB")
+
+    rotulos = {
+        i: f"{'🛒' if d['tipo'] == 'nota' else '💸'} {d['data']} | {d['descricao']} | R$ {d['total']:.2f}"
+        for i, d in enumerate(documentos)
+    }
+    c_doc, c_baixar = st.columns([4, 1])
+    escolhido = c_doc.selectbox("Original", list(rotulos), format_func=rotulos.get)
+    arquivo_hash = documentos[escolhido]["hash"]
+    # O st.tabs roda esta aba a cada render do Histórico: o original (blob + zstd)
+    # só sai do banco depois do clique, e só o escolhido
+    if st.session_state.get("original_carregado") != arquivo_hash:
+        c_baixar.button(
+            "📂 Carregar", on_click=_carregar_original, args=(arquivo_hash,), use_container_width=True
+        )
+    else:
+        arquivo = cache.archived_file(db_manager, db_manager.household_id, arquivo_hash)
+        if arquivo:
+            nome, conteudo = arquivo
+            c_baixar.download_button("⬇️ Baixar", data=conteudo, file_name=nome, use_container_width=True)
+
+    st.markdown("#### ♻️ Reler notas com o parser atual")
+    st.caption("Compara o que foi salvo com uma nova leitura de cada original. Nada é alterado no banco.")
+    notas = [d for d in documentos if d["tipo"] == "nota"]
+    if st.button(f"♻️ Reler {len(notas)} notas arquivadas", disabled=not notas):
+        barra = st.progress(0.0)
+        linhas = []
+        for i, linha in enumerate(archive.reparse_invoices(db_manager, notas), 1):
+            linhas.append(linha)
+            barra.progress(i / len(notas), text=f"{i}/{len(notas)} notas")
+        barra.empty()
+
+        df_releitura = pd.DataFrame(linhas)
+        df_releitura["diferenca"] = (df_releitura["total_relido"] - df_releitura["total_salvo"]).round(2)
+        divergentes = df_releitura[
+            (df_releitura["diferenca"].abs() > 0.01)
+            | (df_releitura["itens_relidos"] != df_releitura["itens_salvos"])
+            | df_releitura["erro"].notna()
+        ]
+        if divergentes.empty:
+            st.success(f"As {len(df_releitura)} notas batem com a nova leitura.")
         else:
-            for r in reembolsos:
-                with st.container(border=True):
-                    c1, c2 = st.columns([4, 1])
-                    c1.markdown(
-                        f"💸 **{r['pagador']}** ➝ **{r['recebedor']}**: R$ {r['valor']:.2f}"
-                    )
-                    c1.caption(f"Data: {r['data_pagamento']}")
-                    if c2.button("🗑️ Excluir", key=f"del_r_{r['id']}"):
-                        db_manager.delete_reimbursement(r["id"])
-                        st.rerun()
+            st.caption(f"{len(divergentes)} de {len(df_releitura)} notas com diferença")
+            st.dataframe(
+                divergentes.drop(columns=["id"]),
+                column_config={
+                    "data": "Data",
+                    "loja": "Loja",
+                    "total_salvo": st.column_config.NumberColumn("Total salvo", format="R$ %.2f"),
+                    "total_relido": st.column_config.NumberColumn("Total relido", format="R$ %.2f"),
+                    "diferenca": st.column_config.NumberColumn("Diferença", format="R$ %.2f"),
+                    "itens_salvos": "Itens salvos",
+                    "itens_relidos": "Itens relidos",
+                    "erro": "Erro",
+                },
+                hide_index=True,
+                use_container_width=True,
+            )
@@ -0,0 +1,92 @@
+import streamlit as st
+import altair as alt
+
+import cache
+import charts
+import perf
+
+
+@perf.timed("ui.render_prices")
+def render_prices(db_manager):
+    st.markdown("### 📈 Histórico de Preços")
+    st.caption(
+        "Preço por unidade (valor ÷ quantidade) de cada produto ao longo do tempo e entre lojas. "
+        "Notas salvas antes desta versão não têm quantidade e ficam de fora."
+    )
+
+    termo = st.text_input("🔎 Buscar produto", placeholder="ex: patinho, leite, café")
+    df_produtos = cache.products(db_manager, db_manager.household_id, termo)
+
+    if df_produtos.empty:
+        st.info("Nenhum produto com histórico de preço para essa busca.")
+        return
+
+    rotulos = {
+        row.product_key: f"{row.item_nome} | {row.compras} compras em {row.lojas} lojas"
+        for row in df_produtos.itertuples()
+    }
+    chave = st.selectbox("Produto", list(rotulos), format_func=rotulos.get)
+
+    # Tudo agregado no banco: aqui só chegam as linhas do produto escolhido
+    df_serie = cache.price_history(db_manager, db_manager.household_id, chave)
+    df_lojas = cache.store_prices(db_manager, db_manager.household_id, chave)
+
+    if df_serie.empty:
+        st.info("Sem compras deste produto.")
+        return
+
+    unidades = sorted(df_serie["un"].dropna().unique().tolist())
+    un = unidades[0]
+    if len(unidades) > 1:
+        # Preço por KG e por UN não se comparam: um gráfico por unidade
+        un = st.radio("Unidade", unidades, horizontal=True)
+    df_serie = df_serie[df_serie["un"] == un]
+    df_lojas = df_lojas[df_lojas["un"] == un]
+
+    ultimo = df_serie.iloc[-1]
+    c1, c2, c3 = st.columns(3)
+    c1.metric(f"Último preço (R$/{un})", f"R$ {ultimo['preco_unitario']:.2f}", delta=ultimo["loja"], delta_color="off")
+    c2.metric(f"Menor preço (R$/{un})", f"R$ {df_lojas['preco_min'].min():.2f}")
+    c3.metric(f"Maior preço (R$/{un})", f"R$ {df_lojas['preco_max'].max():.2f}")
+
+    tab_tempo, tab_lojas = st.tabs(["📈 Evolução", "🏪 Lojas"])
+
+    with tab_tempo:
+        # Uma linha por loja: as lojas com menos compras viram "Outros" e as datas
+        # são agrupadas por período para caber no orçamento de pontos.
+        # Valor e quantidade são somados e o preço sai de valor / qtd (média
+        # ponderada pela quantidade, inclusive em "Outros")
+        compras = df_serie["loja"].value_counts()
+        mantidas = compras.index[: charts.MAX_FATIAS - 1] if len(compras) > charts.MAX_FATIAS else compras.index
+        df_grafico = df_serie.assign(loja=df_serie["loja"].where(df_serie["loja"].isin(mantidas), charts.OUTROS))
+        n_lojas = df_grafico["loja"].nunique()
+        df_grafico, (_, periodo_nome, formato_eixo, formato_tooltip) = charts.bin_time_series(
+            df_grafico, "data_compra", ["valor", "qtd"], max(1, charts.MAX_PONTOS_TEMPO // n_lojas), por=["loja"]
+        )
+        df_grafico["preco_unitario"] = df_grafico["valor"] / df_grafico["qtd"]
+        line = alt.Chart(df_grafico).mark_line(point=True).encode(
+            x=alt.X('data_compra:T', title=f'Data da Nota ({periodo_nome})', axis=alt.Axis(format=formato_eixo)),
+            y=alt.Y('preco_unitario', title=f'R$/{un}'),
+            color=alt.Color('loja', title='Loja'),
+            tooltip=[
+                alt.Tooltip('data_compra:T', format=formato_tooltip, title=periodo_nome),
+                'loja',
+                alt.Tooltip('preco_unitario', format=",.2f", title=f"R$/{un}"),
+            ]
+        ).interactive()
+        st.altair_chart(line, use_container_width=True)
+
+    with tab_lojas:
+        st.dataframe(
+            df_lojas.drop(columns=["un"]),
+            column_config={
+                "loja": "Loja",
+                "preco_medio": st.column_config.NumberColumn(f"Médio (R$/{un})", format="R$ %.2f"),
+                "preco_min": st.column_config.NumberColumn("Mínimo", format="R$ %.2f"),
+                "preco_max": st.column_config.NumberColumn("Máximo", format="R$ %.2f"),
+                "compras": "Compras",
+                "ultima_compra": "Última compra",
+            },
+            hide_index=True,
+            use_container_width=True,
+        )
@@ -1,56 +1,370 @@
+import os
+import uuid
+
 import streamlit as st
 import pandas as pd
-import os
 from datetime import datetime
 
-from parser import InvoiceParser
-from core import ExpenseManager
+from parser import parse_invoice
+from core import ExpenseManager, UserInfo
+from manifest import QueueManifest
+from splits import apply_rules
+from storage import config_value
+import cache
+import perf
 
 BUFFER_DIR = "notas_pendentes"
-if not os.path.exists(BUFFER_DIR):
-    os.makedirs(BUFFER_DIR)
+CATEGORIAS_OPCOES = [
+    "Hortifruti", "Carnes", "Bebidas",
+    "Padaria", "Limpeza", "Higiene", "Geral",
+]
+_filas = {}  # household_id -> QueueManifest (um índice só, filtrado pela casa)
+# Processos para extrair as páginas de PDFs longos: 1 = desligado, 0 = um por CPU
+PARSER_WORKERS = int(config_value("PARSER_WORKERS", 1))
+
+
+def _parse_nota(caminho):
+    # XML da SEFAZ vai pelo leitor nativo; PDF pelo pdfplumber
+    return parse_invoice(caminho, workers=PARSER_WORKERS)
+
+
+def _fila(household_id):
+    # Fila da casa da sessão: uma casa não vê nem salva as notas pendentes de outra
+    if household_id not in _filas:
+        _filas[household_id] = QueueManifest(BUFFER_DIR, household_id)
+    return _filas[household_id]
+
+
+def _sessao_id():
+    # Identifica a sessão nas reservas da fila (uma aba do navegador = uma sessão)
+    if "sessao_id" not in st.session_state:
+        st.session_state["sessao_id"] = uuid.uuid4().hex
+    return st.session_state["sessao_id"]
+
+
+def _indexar(manifest, arquivos, core_manager):
+    # Lê cada nota uma única vez e guarda o resultado no índice da fila
+    for arquivo in arquivos:
+        manifest.index(arquivo, _parse_nota, core_manager.identify_payer)
+
+
+def _original(manifest, arquivo):
+    # (nome, bytes) do arquivo da fila, para o arquivo de originais
+    try:
+        with open(manifest.path_for(arquivo), "rb") as f:
+            return os.path.basename(arquivo), f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _categorias_validas(categorias):
+    return categorias.where(categorias.isin(CATEGORIAS_OPCOES), "Geral")
+
+
+def _processar_itens(df, regras, nomes):
+    """
+    df: uma linha por item (item, qtd, un, valor, Categoria, loja, pagador);
+    pode juntar itens de várias notas. Divide pelas regras e devolve,
+    na mesma ordem, os dicts que o save_invoice espera.
+    """
+    valores = df["valor"].fillna(0.0).astype(float)
+    # Quantidade e preço unitário vão para o histórico de preços
+    quantidades = df["qtd"].fillna(1.0).astype(float)
+    unitarios = (valores / quantidades.where(quantidades > 0)).fillna(valores).round(4)
+
+    # Divisão pelas regras cadastradas (padrão: partes iguais), centavo exato
+    df_regras = pd.DataFrame({
+        "item_nome": df["item"].astype(str),
+        "categoria": df["Categoria"].fillna("Geral"),
+        "loja": df["loja"].fillna(""),
+        "pagador": df["pagador"],
+        "valor": valores,
+    })
+    partes = apply_rules(df_regras, regras, nomes)
+
+    return pd.DataFrame({
+        "Item": df["item"].astype(str),
+        "Valor (R$)": valores,
+        "Categoria": df["Categoria"].fillna("Geral"),
+        "Qtd": quantidades,
+        "Un": df["un"].fillna("UN"),
+        "Vl Unit": unitarios,
+        "Partes": partes.to_dict("records"),
+    }).to_dict("records")
+
+
+def _abrir_no_editor(arquivo):
+    # Callback (roda antes do script): pode mexer no estado dos widgets
+    st.session_state["nota_atual"] = arquivo
+    st.session_state["modo_lote"] = False
+
+
+@perf.timed("ui.render_lote")
+def _render_lote(db_manager, sessao, nomes):
+    """
+    Revisão em lote: notas cujos itens já estão todos na memória são
+    confirmadas juntas, numa transação só. As demais vão para o editor.
+    """
+    manifest = _fila(db_manager.household_id)
+    entradas = [r for r in manifest.entries(sessao) if not r["em_uso"]]
+    if not entradas:
+        st.info("🎉 Nenhuma nota livre na fila.")
+        return
 
+    dados = manifest.get_parsed_many([r["arquivo"] for r in entradas])
+    # Mesmo arquivo de uma nota já salva: vai para o editor, com o aviso
+    ja_salvas = db_manager.get_invoices_by_file(r["hash"] for r in entradas)
+    # Uma consulta para os itens de todas as notas
+    aprendidas = db_manager.get_learned_categories(
+        str(item["item"]) for d in dados.values() for item in d.get("itens", [])
+    )
+
+    prontas, pendentes, linhas_itens = [], [], []
+    for r in entradas:
+        d = dados.get(r["arquivo"])
+        if d is None:
+            pendentes.append({"arquivo": r["arquivo"], "loja": r["loja"], "total": r["total"], "motivo": f"⚠️ {r['status']}"})
+            continue
+        itens = d.get("itens", [])
+        # Desconto (valor negativo) não precisa de categoria aprendida
+        novos = [i for i in itens if i["valor"] >= 0 and str(i["item"]) not in aprendidas]
+        try:
+            datetime.strptime(d.get("data") or "", "%d/%m/%Y")
+        except ValueError:
+            pendentes.append({"arquivo": r["arquivo"], "loja": r["loja"], "total": r["total"], "motivo": "Sem data"})
+            continue
+        if not itens or novos or r["hash"] in ja_salvas:
+            motivo = f"{len(novos)} itens novos" if novos else "Sem itens"
+            if r["hash"] in ja_salvas:
+                motivo = f"Já salva ({ja_salvas[r['hash']]})"
+            pendentes.append({"arquivo": r["arquivo"], "loja": r["loja"], "total": r["total"], "motivo": motivo})
+            continue
+
+        df_nota = pd.DataFrame(itens)
+        df_nota["Categoria"] = _categorias_validas(df_nota["item"].astype(str).map(aprendidas).fillna("Geral"))
+        por_categoria = df_nota.groupby("Categoria")["valor"].sum().sort_values(ascending=False)
+        prontas.append({
+            "confirmar": True,
+            "arquivo": r["arquivo"],
+            "loja": d.get("loja") or "Loja não identificada",
+            "data": d.get("data"),
+            "total": round(float(df_nota["valor"].sum()), 2),
+            "categorias": " · ".join(f"{c} R$ {v:.2f}" for c, v in por_categoria.items()),
+            "pagador": r["pagador"] if r["pagador"] in nomes else "Outro",
+            "forma_pagamento": d.get("forma_pagamento", "Indefinido"),
+        })
+        linhas_itens.append(df_nota.assign(arquivo=r["arquivo"], loja=d.get("loja") or ""))
+
+    st.markdown(f"#### ⚡ {len(prontas)} notas prontas para confirmar")
+    if prontas:
+        df_lote = pd.DataFrame(prontas)
+        # A key muda com o conjunto de notas: edições antigas não caem na linha errada
+        editado = st.data_editor(
+            df_lote,
+            key=f"editor_lote_{hash(tuple(df_lote['arquivo']))}",
+            hide_index=True,
+            use_container_width=True,
+            column_order=["confirmar", "loja", "data", "total", "categorias", "pagador", "forma_pagamento"],
+            disabled=["loja", "data", "total", "categorias", "forma_pagamento"],
+            column_config={
+                "confirmar": st.column_config.CheckboxColumn("✅"),
+                "loja": "Loja",
+                "data": "Data",
+                "total": st.column_config.NumberColumn("Total", format="R$ %.2f"),
+                "categorias": st.column_config.TextColumn("Por categoria", width="large"),
+                "pagador": st.column_config.SelectboxColumn("Quem pagou?", options=nomes + ["Outro"], required=True),
+                "forma_pagamento": "Pagamento",
+            },
+        )
+        selecionadas = editado[editado["confirmar"]]
+        c_total, c_botao = st.columns([3, 1])
+        c_total.metric("Total selecionado", f"R$ {selecionadas['total'].sum():.2f}")
+
+        if c_botao.button(f"💾 Salvar {len(selecionadas)} notas", type="primary", disabled=selecionadas.empty, use_container_width=True):
+            # Reserva todas de uma vez; alguma pega por outra pessoa nesse meio tempo fica de fora
+            obtidas = manifest.claim_many(sessao, selecionadas["arquivo"].tolist())
+            selecionadas = selecionadas[selecionadas["arquivo"].isin(obtidas)]
+
+            df_itens = pd.concat(linhas_itens, ignore_index=True)
+            df_itens = df_itens[df_itens["arquivo"].isin(obtidas)]
+            df_itens["pagador"] = df_itens["arquivo"].map(selecionadas.set_index("arquivo")["pagador"])
+            df_itens["processado"] = _processar_itens(df_itens, cache.split_rules(db_manager, db_manager.household_id), nomes)
+
+            notas = [
+                {
+                    "data": nota["data"],
+                    "loja": nota["loja"],
+                    "total": nota["total"],
+                    "pagador": nota["pagador"],
+                    "forma_pagamento": nota["forma_pagamento"],
+                    "itens": df_itens.loc[df_itens["arquivo"] == nota["arquivo"], "processado"].tolist(),
+                    "arquivo": _original(manifest, nota["arquivo"]),
+                }
+                for nota in selecionadas.to_dict("records")
+            ]
+            if db_manager.save_invoices(notas):
+                for arquivo in obtidas:
+                    manifest.remove(arquivo, sessao)
+                cache.invalidate()
+                st.toast(f"{len(notas)} notas salvas!", icon="✅")
+                if len(obtidas) < len(editado[editado["confirmar"]]):
+                    st.toast("Algumas notas foram pegas por outra pessoa e ficaram de fora.", icon="🔒")
+                st.rerun()
+            else:
+                manifest.release(sessao)
+                st.error("Erro ao salvar as notas. Nenhuma foi gravada; tente novamente.")
+    else:
+        st.caption("Nenhuma nota com todos os itens já conhecidos.")
+
+    if pendentes:
+        st.markdown(f"#### 📝 {len(pendentes)} notas precisam do editor detalhado")
+        df_pendentes = pd.DataFrame(pendentes)
+        st.dataframe(
+            df_pendentes[["loja", "total", "motivo"]],
+            column_config={
+                "loja": "Loja",
+                "total": st.column_config.NumberColumn("Total", format="R$ %.2f"),
+                "motivo": "Motivo",
+            },
+            hide_index=True,
+            use_container_width=True,
+        )
+        rotulos = {p["arquivo"]: f"{p['loja'] or p['arquivo']} | {p['motivo']}" for p in pendentes}
+        c_nota, c_abrir = st.columns([3, 1])
+        escolhida = c_nota.selectbox("Nota", list(rotulos), format_func=rotulos.get, label_visibility="collapsed")
+        c_abrir.button(
+            "📝 Abrir no editor", on_click=_abrir_no_editor, args=(escolhida,), use_container_width=True
+        )
+
+
+@perf.timed("ui.render_processor")
 def render_processor(db_manager):
     st.markdown("### 📥 Central de Uploads")
+    # Participantes da casa: opções de pagador, CPFs para o palpite e colunas da divisão
+    participantes = cache.participants(db_manager, db_manager.household_id)
+    nomes = [p["nome"] for p in participantes]
+    core_manager = ExpenseManager()
+    core_manager.config.users = {p["nome"]: UserInfo(nome=p["nome"], cpf=p["cpf"]) for p in participantes}
+    manifest = _fila(db_manager.household_id)
 
     # --- PARTE A: UPLOAD PARA A FILA ---
     with st.expander("📤 Adicionar novas notas à fila", expanded=False):
         uploaded_files = st.file_uploader(
-            "Selecione arquivos (PDF)",
-            type="pdf",
+            "Selecione arquivos (PDF ou XML da NFC-e/NF-e)",
+            type=["pdf", "xml"],
             accept_multiple_files=True,
+            key=f"uploader_{st.session_state.get('uploader_gen', 0)}",
         )
         if uploaded_files:
-            for f in uploaded_files:
-                with open(os.path.join(BUFFER_DIR, f.name), "wb") as buffer:
-                    buffer.write(f.getbuffer())
-            st.success(f"{len(uploaded_files)} notas enviadas para a fila!")
+            novos = []
+            with st.spinner("Lendo notas..."):
+                for f in uploaded_files:
+                    arquivo = manifest.add(f.name, f.getvalue())
+                    if arquivo:
+                        novos.append(arquivo)
+                _indexar(manifest, novos, core_manager)
+            duplicadas = len(uploaded_files) - len(novos)
+            st.toast(f"{len(novos)} notas enviadas para a fila!", icon="✅")
+            if duplicadas:
+                st.toast(f"{duplicadas} notas ignoradas (já estavam na fila).", icon="⚠️")
+            # Troca a key do uploader para limpar os arquivos já enviados
+            st.session_state["uploader_gen"] = st.session_state.get("uploader_gen", 0) + 1
             st.rerun()
 
     # --- PARTE B: SELECIONAR DA FILA ---
-    pendentes = [f for f in os.listdir(BUFFER_DIR) if f.lower().endswith(".pdf")]
+    # Reconcilia com a pasta só uma vez por sessão (ou sob demanda):
+    # a lista vem do índice, sem listar a pasta nem abrir PDFs a cada rerun
+    sincronizada = f"fila_sincronizada_{db_manager.household_id}"
+    if not st.session_state.get(sincronizada):
+        _indexar(manifest, manifest.sync(), core_manager)
+        st.session_state[sincronizada] = True
+
+    sessao = _sessao_id()
+    # Antes de qualquer retorno de fila vazia: arquivos copiados direto para a
+    # pasta só aparecem depois de reindexar
+    c_modo, c_sync = st.columns([4, 1])
+    if c_sync.button("🔄 Reindexar pasta", use_container_width=True):
+        st.session_state[sincronizada] = False
+        st.rerun()
+    modo_lote = c_modo.toggle(
+        "⚡ Revisão em lote",
+        key="modo_lote",
+        help="Confirma de uma vez as notas cujos itens já estão todos na memória.",
+    )
+    if modo_lote:
+        # No lote a sessão não segura nenhuma nota avulsa
+        manifest.release(sessao)
+        _render_lote(db_manager, sessao, nomes)
+        return
+
+    # Reserva a nota escolhida (ou a próxima livre): cada revisor fica com uma nota diferente
+    preferida = st.session_state.get("nota_atual")
+    arquivo_selecionado = manifest.claim(sessao, preferida)
+    if preferida and arquivo_selecionado != preferida:
+        st.toast("Essa nota foi pega por outra pessoa; abrindo a próxima livre.", icon="🔒")
+    pendentes = manifest.entries(sessao)
 
     if not pendentes:
         st.info("🎉 Fila vazia! Nenhuma nota pendente.")
         return
 
-    st.markdown(f"#### 📋 Fila: {len(pendentes)} notas aguardando")
-    arquivo_selecionado = st.selectbox("Nota atual:", pendentes, index=0)
-    current_file_path = os.path.join(BUFFER_DIR, arquivo_selecionado)
+    df_fila = pd.DataFrame(pendentes)
+    em_uso = int(df_fila["em_uso"].sum())
 
-    # --- PARTE C: PROCESSAMENTO ---
-    parser = InvoiceParser(current_file_path)
-    core_manager = ExpenseManager()
+    st.markdown(f"#### 📋 Fila: {len(pendentes)} notas aguardando")
+    if em_uso:
+        st.caption(f"🔒 {em_uso} em revisão por outras pessoas")
+
+    with st.expander("🔎 Ver fila completa", expanded=False):
+        f_col1, f_col2 = st.columns(2)
+        busca_loja = f_col1.text_input("Filtrar por loja")
+        status_sel = f_col2.multiselect("Status", ["ok", "erro", "pendente"], default=[])
+
+        df_view = df_fila
+        if busca_loja:
+            df_view = df_view[df_view["loja"].fillna("").str.contains(busca_loja, case=False, regex=False)]
+        if status_sel:
+            df_view = df_view[df_view["status"].isin(status_sel)]
+
+        st.dataframe(
+            df_view[["arquivo", "loja", "data", "total", "pagador", "n_itens", "status", "em_uso", "enviado_em", "tamanho"]],
+            column_config={
+                "total": st.column_config.NumberColumn("Total", format="R$ %.2f"),
+                "em_uso": st.column_config.CheckboxColumn("🔒 Em uso"),
+                "tamanho": st.column_config.NumberColumn("Bytes"),
+            },
+            hide_index=True,
+            use_container_width=True,
+        )
 
-    try:
-        data = parser.parse()
-    except Exception as e:
-        st.error(f"Erro ao ler PDF: {e}")
-        if st.button("🗑️ Deletar arquivo corrompido"):
-            os.remove(current_file_path)
-            st.rerun()
+    if arquivo_selecionado is None:
+        st.info("👥 Todas as notas pendentes estão sendo revisadas por outras pessoas.")
         return
 
+    # Só as notas livres (e a reservada por esta sessão) aparecem para escolha
+    rotulos = {
+        r["arquivo"]: f"{r['loja'] or r['arquivo']} | {r['data'] or '?'} | R$ {r['total'] or 0:.2f}"
+        if r["status"] == "ok" else f"⚠️ {r['arquivo']} ({r['status']})"
+        for r in pendentes
+        if not r["em_uso"] or r["arquivo"] == arquivo_selecionado
+    }
+    st.session_state["nota_atual"] = arquivo_selecionado
+    st.selectbox("Nota atual:", list(rotulos), key="nota_atual", format_func=rotulos.get)
+    current_file_path = manifest.path_for(arquivo_selecionado)
+
+    # --- PARTE C: PROCESSAMENTO ---
+    # Usa o parse feito no upload; só relê o arquivo se ele ainda não foi indexado
+    data = manifest.get_parsed(arquivo_selecionado)
+    if data is None:
+        try:
+            data = _parse_nota(current_file_path)
+        except Exception as e:
+            st.error(f"Erro ao ler nota: {e}")
+            if st.button("🗑️ Deletar arquivo corrompido"):
+                manifest.remove(arquivo_selecionado, sessao)
+                st.rerun()
+            return
+
     st.markdown("---")
 
     # Metadados (Data, Loja, Pagador)
@@ -73,120 +387,96 @@ def render_processor(db_manager):
     c2.info(f"🛒 {data.get('loja', 'Loja não identificada')}")
     c3.info(f"💳 {data.get('forma_pagamento', 'Indefinido')}")
 
-    opcoes_pagador = ["Kristian", "Giulia", "Outro"]
+    opcoes_pagador = nomes + ["Outro"]
     sugestao = core_manager.identify_payer(data.get("cpf_consumidor"))
-    idx_pagador = opcoes_pagador.index(sugestao) if sugestao in opcoes_pagador else 2
+    idx_pagador = opcoes_pagador.index(sugestao) if sugestao in opcoes_pagador else len(nomes)
     pagador_final = c4.selectbox("Quem pagou?", opcoes_pagador, index=idx_pagador)
 
+    # O original das notas salvas fica arquivado: o mesmo arquivo de novo é duplicata
+    hash_atual = next(r["hash"] for r in pendentes if r["arquivo"] == arquivo_selecionado)
+    ja_salva = db_manager.get_invoices_by_file([hash_atual]).get(hash_atual)
+    if ja_salva:
+        st.warning(f"⚠️ Este arquivo já foi salvo (compra de {ja_salva}). Salvar de novo duplica os gastos.")
+
     st.markdown("### 📝 Classificar Itens")
 
     itens_raw = data.get("itens", [])
-df_itens = pd.DataFrame(itens_raw)
-
-if df_itens.empty:
-    st.warning("Nenhum item identificado na nota.")
-    return
-
-# ---- NOVO: função que usa memória + fallback ----
-def sugerir_categoria(nome_item: str) -> str:
-    if not nome_item:
-        return "Geral"
-
-    # 1) Tenta memória no banco
-    learned = db_manager.get_learned_category(nome_item)
-    if learned:
-        return learned
-
-    # 2) Se não tiver memória, usa o palpite padrão
-    return core_manager.categorize_item(nome_item)
-
-# Usa a função acima para preencher a coluna Categoria
-df_itens["Categoria"] = df_itens["item"].apply(
-    lambda nome: sugerir_categoria(str(nome))
-)
-    # --- FORM de edição + salvamento ---
-    with st.form("form_editar_nota"):
-        # Cabeçalho visual
-        c_h1, c_h2, c_h3, c_h4 = st.columns([5, 1, 1.5, 1.5])
-        c_h1.markdown("**Item**")
-        c_h2.markdown("**Qtd**")
-        c_h3.markdown("**Valor (R$)**")
-        c_h4.markdown("**Categoria**")
-
-        itens_processados = []
-        total_nota = 0.0
-
-        for idx, row in df_itens.iterrows():
-            c1, c2, c3, c4 = st.columns([5, 1, 1.5, 1.5])
-
-            nome_item = c1.text_input(
-                "Nome",
-                value=str(row["item"]),
-                key=f"nome_{idx}",
-                label_visibility="collapsed",
-            )
-            qtd_item = c2.number_input(
-                "Qtd",
-                value=float(row.get("qtd", 1.0) or 1.0),
-                min_value=0.0,
-                step=0.1,
-                key=f"qtd_{idx}",
-                label_visibility="collapsed",
-            )
-            valor_item = c3.number_input(
-                "Valor (R$)",
-                value=float(row.get("valor", 0.0) or 0.0),
-                min_value=0.0,
-                step=0.1,
-                key=f"valor_{idx}",
-                label_visibility="collapsed",
-            )
-
-            # Sugestão de categoria
-            categorias_opcoes = [
-                "Hortifruti", "Carnes", "Bebidas",
-                "Padaria", "Limpeza", "Higiene", "Geral",
+    if not itens_raw:
+        st.warning("Nenhum item identificado na nota.")
+        return
+
+    # As sugestões são calculadas uma vez por nota e ficam na sessão:
+    # editar a grade não repete as consultas à memória
+    cache_key = f"itens_{arquivo_selecionado}"
+    if cache_key not in st.session_state:
+        df_itens = pd.DataFrame(itens_raw)
+        with perf.span("processor.sugerir_categorias"):
+            # 1) Memória do banco (uma consulta para a nota inteira)
+            # 2) Sem memória, o palpite padrão
+            aprendidas = db_manager.get_learned_categories(df_itens["item"].astype(str))
+            df_itens["Categoria"] = [
+                aprendidas.get(nome) or (core_manager.categorize_item(nome) if nome else "Geral")
+                for nome in df_itens["item"].astype(str)
             ]
-            cat_sugerida = row["Categoria"] if row.get("Categoria") else "Geral"
-            idx_cat = categorias_opcoes.index(cat_sugerida) if cat_sugerida in categorias_opcoes else len(categorias_opcoes) - 1
-            
-            categoria_escolhida = c4.selectbox(
-                "Categoria",
-                categorias_opcoes,
-                index=idx_cat,
-                key=f"cat_{idx}",
-                label_visibility="collapsed",
-            )
-
-
-            total_nota += valor_item
-
-            # Aqui você poderia dividir entre Kristian e Giulia (regra que já tiver)
-            # Exemplo simples: 50/50
-            valor_k = round(valor_item / 2.0, 2)
-            valor_g = round(valor_item - valor_k, 2)
-
-            itens_processados.append(
-                {
-                    "Item": nome_item,
-                    "Valor (R$)": valor_item,
-                    "Categoria": categoria_escolhida,
-                    "R$ Kristian": valor_k,
-                    "R$ Giulia": valor_g,
-                }
-            )
+        df_itens["Categoria"] = _categorias_validas(df_itens["Categoria"])
+        st.session_state[cache_key] = df_itens[["item", "qtd", "un", "valor", "Categoria"]]
+    df_itens = st.session_state[cache_key]
+
+    _render_itens(
+        db_manager, manifest, sessao, arquivo_selecionado, data,
+        data_formatada_str, pagador_final, nomes, df_itens,
+    )
+
 
-        # --- Resumo da nota ---
-        st.markdown("---")
-        col_res1, col_res2, col_res3 = st.columns(3)
-        col_res1.metric("Total da Nota", f"R$ {total_nota:.2f}")
-        col_res2.metric("Qtd de Itens", len(itens_processados))
-        col_res3.metric("Pagador", pagador_final)
+# Editar uma célula da grade reexecuta só este fragmento: a reserva da nota,
+# a checagem de duplicata e a fila não são refeitas a cada tecla
+@st.fragment
+@perf.timed("ui.processor.itens")
+def _render_itens(db_manager, manifest, sessao, arquivo_selecionado, data,
+                  data_formatada_str, pagador_final, nomes, df_itens):
+    # --- Grade de edição (um único widget para todos os itens) ---
+    df_editado = st.data_editor(
+        df_itens,
+        key=f"editor_{arquivo_selecionado}",
+        num_rows="dynamic",
+        hide_index=True,
+        use_container_width=True,
+        column_config={
+            "item": st.column_config.TextColumn("Item", width="large", required=True),
+            "qtd": st.column_config.NumberColumn("Qtd", min_value=0.0, step=0.001, format="%.3f"),
+            "un": st.column_config.TextColumn("Un", width="small"),
+            # Sem min_value: o desconto entra como item negativo
+            "valor": st.column_config.NumberColumn("Valor (R$)", step=0.01, format="%.2f", required=True),
+            "Categoria": st.column_config.SelectboxColumn("Categoria", options=CATEGORIAS_OPCOES, required=True),
+        },
+    )
+
+    # Totais e divisão calculados de uma vez sobre a grade editada
+    df_editado = df_editado[df_editado["item"].fillna("").str.strip() != ""]
+    total_nota = float(df_editado["valor"].fillna(0.0).astype(float).sum())
+    itens_processados = _processar_itens(
+        df_editado.assign(loja=data.get("loja") or "", pagador=pagador_final),
+        cache.split_rules(db_manager, db_manager.household_id),
+        nomes,
+    )
 
-        salvar = st.form_submit_button("💾 Salvar nota e remover da fila")
+    # --- Resumo da nota ---
+    st.markdown("---")
+    col_res1, col_res2, col_res3 = st.columns(3)
+    col_res1.metric("Total da Nota", f"R$ {total_nota:.2f}")
+    col_res2.metric("Qtd de Itens", len(itens_processados))
+    col_res3.metric("Pagador", pagador_final)
+
+    salvar = st.button("💾 Salvar nota e remover da fila", type="primary")
 
     # --- Pós-submit ---
     if salvar:
+        # Renova a reserva antes de gravar: se ela venceu e outra pessoa pegou a nota, não salva de novo
+        if manifest.claim(sessao, arquivo_selecionado) != arquivo_selecionado:
+            st.error("Sua reserva desta nota expirou e outra pessoa está com ela. Escolha outra nota.")
+            st.session_state.pop("nota_atual", None)
+            return
+
         sucesso = db_manager.save_invoice(
             data_formatada_str,
             data.get("loja", "Loja não identificada"),
@@ -194,17 +484,18 @@ df_itens["Categoria"] = df_itens["item"].apply(
             pagador_final,
             data.get("forma_pagamento", "Indefinido"),
             itens_processados,
+            arquivo=_original(manifest, arquivo_selecionado),
         )
 
         if sucesso:
-            # Aprendizado: salva categorias escolhidas na memória
-            for item in itens_processados:
-                db_manager.learn_item(item["Item"], item["Categoria"])
-
+            # As categorias escolhidas já foram para a memória junto com a nota
+            cache.invalidate()
             st.toast("Nota salva com sucesso!", icon="✅")
 
-            # Remove o PDF da fila após salvar
-            os.remove(current_file_path)
+            # O original já está no arquivo: remove da fila; a próxima livre é reservada no rerun
+            manifest.remove(arquivo_selecionado, sessao)
+            st.session_state.pop(f"itens_{arquivo_selecionado}", None)
+            st.session_state.pop("nota_atual", None)
             st.rerun()
         else:
             st.error("Erro ao salvar nota. Tente novamente.")